@@ -0,0 +1,257 @@
+import numpy as np
+
+SAMPLE_BUDGET = 1 << 28
+# Slack is a difference of float sums over the whole path, so it is only
+# late beyond rounding, relative to the makespan.
+SLACK_TOLERANCE = 1e-9
+
+
+class Level(object):
+    def __init__(self, nodes, edge_src, edge_dst, starts, positions):
+        self.nodes = nodes
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.starts = starts
+        self.positions = positions
+
+
+class NodeGraph(object):
+    # Tasks occupy nodes [0, num_tasks), comms the nodes after them.
+    def __init__(self, graph, allow_share=False, rate=125829120,
+                 ordered=True):
+        n = graph.num_tasks
+        self.num_tasks = n
+        self.num_nodes = n + graph.num_comms
+        self.release = np.concatenate(
+            [graph.planned_st, graph.comm_planned_st])
+        self.planned_ft = np.concatenate([
+            graph.planned_st + graph.runtime, graph.comm_planned_ft])
+        # Comms last whole seconds, as Comm.duration has them.
+        self.durations = np.concatenate(
+            [graph.runtime, np.ceil(graph.data_size / rate)])
+        self.rate = rate
+
+        comm_nodes = np.arange(n, self.num_nodes, dtype=np.int64)
+        src = [graph.succ_src, graph.comm_src, comm_nodes]
+        dst = [graph.succ_idx, comm_nodes, graph.comm_dst]
+        orders = []
+        if ordered:
+            orders.append((np.arange(n, dtype=np.int64), graph.machine))
+        if ordered and not allow_share:
+            orders.append((comm_nodes, graph.machine[graph.comm_src]))
+            orders.append((comm_nodes, graph.machine[graph.comm_dst]))
+        for nodes, groups in orders:
+            s, d = self.sequence_edges(nodes, groups)
+            src.append(s)
+            dst.append(d)
+        self.edge_src = np.concatenate(src).astype(np.int64)
+        self.edge_dst = np.concatenate(dst).astype(np.int64)
+        self.levels = self.topological_levels()
+
+    def sequence_edges(self, nodes, groups):
+        # Keep the planned order on each machine: a node waits for the
+        # latest node of its group that was planned to finish before it.
+        src, dst = [], []
+        for group in np.unique(groups):
+            members = nodes[groups == group]
+            members = members[np.argsort(self.planned_ft[members],
+                                         kind="stable")]
+            ft = self.planned_ft[members]
+            prev = np.searchsorted(ft, self.release[members], "right") - 1
+            valid = prev >= 0
+            prev = members[prev[valid]]
+            succ = members[valid]
+            valid = self.release[prev] < self.release[succ]
+            src.append(prev[valid])
+            dst.append(succ[valid])
+        if not src:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        return np.concatenate(src), np.concatenate(dst)
+
+    def topological_levels(self):
+        num_nodes = self.num_nodes
+        order = np.argsort(self.edge_src, kind="stable")
+        out_dst = self.edge_dst[order]
+        out_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        out_ptr[1:] = np.cumsum(np.bincount(self.edge_src,
+                                            minlength=num_nodes))
+        indegree = np.bincount(self.edge_dst, minlength=num_nodes)
+        level_of = np.empty(num_nodes, dtype=np.int64)
+        frontier = np.flatnonzero(indegree == 0)
+        fronts = []
+        while frontier.size:
+            level_of[frontier] = len(fronts)
+            fronts.append(frontier)
+            counts = out_ptr[frontier + 1] - out_ptr[frontier]
+            offsets = np.repeat(out_ptr[frontier] - np.cumsum(counts) + counts,
+                                counts)
+            targets = out_dst[offsets + np.arange(counts.sum())]
+            indegree -= np.bincount(targets, minlength=num_nodes)
+            frontier = np.unique(targets[indegree[targets] == 0])
+        if sum(f.size for f in fronts) != num_nodes:
+            raise ValueError("Schedule graph contains a cycle")
+
+        order = np.lexsort((self.edge_dst, level_of[self.edge_dst]))
+        edge_src = self.edge_src[order]
+        edge_dst = self.edge_dst[order]
+        bounds = np.searchsorted(level_of[edge_dst],
+                                 np.arange(len(fronts) + 1))
+        levels = []
+        for nodes, lo, hi in zip(fronts, bounds, bounds[1:]):
+            dst, starts = np.unique(edge_dst[lo:hi], return_index=True)
+            levels.append(
+                Level(nodes, edge_src[lo:hi], edge_dst[lo:hi], starts,
+                      np.searchsorted(nodes, dst)))
+        return levels
+
+    # Timings are node-major, shape (num_nodes, samples), so that gathering
+    # the predecessors of a level reads contiguous rows.
+    def forward(self, durations, release=None):
+        if release is None:
+            release = self.release
+        samples = durations.shape[1]
+        start = np.empty((self.num_nodes, samples))
+        finish = np.empty((self.num_nodes, samples))
+        for level in self.levels:
+            st = np.repeat(release[level.nodes][:, None], samples, 1)
+            if level.edge_src.size:
+                ready = np.maximum.reduceat(
+                    finish[level.edge_src], level.starts, axis=0)
+                st[level.positions] = np.maximum(st[level.positions], ready)
+            start[level.nodes] = st
+            finish[level.nodes] = st + durations[level.nodes]
+        return start, finish
+
+    def critical(self, start, finish):
+        samples = start.shape[1]
+        critical = np.zeros(start.shape, dtype=bool)
+        critical[finish.argmax(axis=0), np.arange(samples)] = True
+        for level in reversed(self.levels):
+            if not level.edge_src.size:
+                continue
+            tight = critical[level.edge_dst] & (
+                finish[level.edge_src] == start[level.edge_dst])
+            np.logical_or.at(critical, level.edge_src, tight)
+        return critical
+
+    def backward(self, durations, horizon):
+        latest_finish = np.full(self.num_nodes, float(horizon))
+        latest_start = np.empty(self.num_nodes)
+        for level in reversed(self.levels):
+            latest_start[level.nodes] = (
+                latest_finish[level.nodes] - durations[level.nodes])
+            if level.edge_src.size:
+                np.minimum.at(latest_finish, level.edge_src,
+                              latest_start[level.edge_dst])
+        return latest_start
+
+
+class MonteCarloResult(object):
+    def __init__(self, makespans, criticality, num_tasks):
+        self.makespans = makespans
+        self.task_criticality = criticality[:num_tasks]
+        self.comm_criticality = criticality[num_tasks:]
+
+    def percentile(self, q):
+        return np.percentile(self.makespans, q)
+
+    def summary(self):
+        p5, p50, p95 = np.percentile(self.makespans, [5, 50, 95])
+        return {
+            "samples": len(self.makespans),
+            "mean": float(self.makespans.mean()),
+            "std": float(self.makespans.std()),
+            "min": float(self.makespans.min()),
+            "p5": float(p5),
+            "p50": float(p50),
+            "p95": float(p95),
+            "max": float(self.makespans.max()),
+        }
+
+
+def monte_carlo(scheduler, samples=1000, runtime_cv=0.1, data_cv=0.1,
+                seed=None):
+    nodes = NodeGraph(scheduler.graph, scheduler.allow_share,
+                      scheduler.comm_cls.rate)
+    rng = np.random.default_rng(seed)
+    n = nodes.num_tasks
+    cv = np.empty(nodes.num_nodes)
+    cv[:n] = runtime_cv
+    cv[n:] = data_cv
+    batch = max(1, SAMPLE_BUDGET // (nodes.num_nodes * 8 * 4))
+    makespans = []
+    critical_counts = np.zeros(nodes.num_nodes)
+    for lo in range(0, samples, batch):
+        size = min(batch, samples - lo)
+        noise = rng.normal(1, cv[:, None], (nodes.num_nodes, size))
+        durations = nodes.durations[:, None] * np.maximum(noise, 0)
+        start, finish = nodes.forward(durations)
+        makespans.append(finish.max(axis=0))
+        critical_counts += nodes.critical(start, finish).sum(axis=1)
+    return MonteCarloResult(
+        np.concatenate(makespans), critical_counts / samples, n)
+
+
+class ScheduleAnalysis(object):
+    def __init__(self, scheduler):
+        graph = scheduler.graph
+        rate = scheduler.comm_cls.rate
+        n = graph.num_tasks
+        self.tids = graph.tids
+        self.planned_makespan = float(
+            max(np.max(graph.planned_st + graph.runtime, initial=0),
+                np.max(graph.comm_planned_ft, initial=0)))
+
+        dag = NodeGraph(graph, scheduler.allow_share, rate, ordered=False)
+        durations = dag.durations[:, None]
+        start, finish = dag.forward(durations, np.zeros(dag.num_nodes))
+        self.critical_path_length = float(finish.max(initial=0))
+        on_path = np.flatnonzero(dag.critical(start, finish)[:n, 0])
+        self.critical_path = graph.tids[on_path[np.argsort(
+            start[on_path, 0], kind="stable")]].tolist()
+
+        plan = NodeGraph(graph, scheduler.allow_share, rate)
+        start, _ = plan.forward(plan.durations[:, None])
+        self.earliest_start = start[:n, 0]
+        self.latest_start = plan.backward(plan.durations,
+                                          self.planned_makespan)[:n]
+        self.slack = self.latest_start - graph.planned_st
+
+        capacities = np.array([m.capacities for m in scheduler.machines],
+                              dtype=np.float64).reshape(-1, 2)
+        num_machines = len(capacities)
+        work = np.zeros((num_machines, 2))
+        np.add.at(work, graph.machine, graph.demands * graph.runtime[:, None])
+        longest = np.zeros(num_machines)
+        np.maximum.at(longest, graph.machine, graph.runtime)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bounds = np.where(capacities > 0, work / capacities, 0)
+        self.machine_lower_bounds = np.maximum(bounds.max(axis=1), longest)
+        self.lower_bound = float(
+            max(self.critical_path_length,
+                self.machine_lower_bounds.max(initial=0)))
+
+        self.comm_volume = np.bincount(
+            graph.machine[graph.comm_src] * num_machines +
+            graph.machine[graph.comm_dst],
+            weights=graph.data_size,
+            minlength=num_machines**2).reshape(num_machines, num_machines)
+
+    @property
+    def late_tasks(self):
+        tolerance = SLACK_TOLERANCE * max(self.planned_makespan, 1)
+        return self.tids[self.slack < -tolerance].tolist()
+
+    def summary(self):
+        return {
+            "planned_makespan": self.planned_makespan,
+            "critical_path_length": self.critical_path_length,
+            "lower_bound": self.lower_bound,
+            "min_slack": float(self.slack.min()) if self.slack.size else 0.0,
+            "late_tasks": len(self.late_tasks),
+            "comm_volume": float(self.comm_volume.sum()),
+        }
+
+
+def analyze(scheduler):
+    return ScheduleAnalysis(scheduler)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from timeit import default_timer as timer
+from tqdm import tqdm
+from scheduler import Scheduler
+
+FIELDS = ["alg_name", "path", "makespan", "load_time", "eval_time"]
+
+
+def evaluate(path, scheduler_cls=Scheduler, mode="simulate", **kwargs):
+    st = timer()
+    s = scheduler_cls(**kwargs)
+    s.load(path)
+    load_time = timer() - st
+    st = timer()
+    makespan = getattr(s, mode)(log="q")
+    return {
+        "alg_name": s.alg_name,
+        "path": path,
+        "makespan": makespan,
+        "load_time": load_time,
+        "eval_time": timer() - st,
+    }
+
+
+def run_batch(paths, jobs=None, scheduler_cls=Scheduler, mode="simulate",
+              **kwargs):
+    results = [None] * len(paths)
+    pbar = tqdm(total=len(paths), unit="run")
+    if jobs == 1:
+        for i, path in enumerate(paths):
+            results[i] = evaluate(path, scheduler_cls, mode, **kwargs)
+            pbar.set_postfix_str(results[i]["alg_name"])
+            pbar.update()
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = {
+                executor.submit(evaluate, path, scheduler_cls, mode, **kwargs):
+                i
+                for i, path in enumerate(paths)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                pbar.set_postfix_str(future.result()["alg_name"])
+                pbar.update()
+    pbar.close()
+    return results
+
+
+def write_results(results, path=None):
+    if path is None:
+        for r in results:
+            print("{:<32}{:>12.2f}s{:>10.3f}s{:>10.3f}s".format(
+                r["alg_name"], r["makespan"], r["load_time"],
+                r["eval_time"]))
+    elif path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def main(scheduler_cls=Scheduler, mode="simulate", jobs=None, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Evaluate schedule files and aggregate their makespans")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=jobs,
+        help="number of worker processes (default: one per core)")
+    parser.add_argument(
+        "-o", "--output", help="write results to a .csv or .json file")
+    args = parser.parse_args()
+    results = run_batch(args.paths, args.jobs or os.cpu_count(),
+                        scheduler_cls, mode, **kwargs)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
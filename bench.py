@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import numpy as np
+from timeit import default_timer as timer
+from cluster import Cluster, FakeEC2Backend
+from monitor import Monitor
+from worker import Worker, Task, Data, bin_format
+
+HIGHER_IS_BETTER = {"rate"}
+SIZES = [1 << 20, 16 << 20, 128 << 20]
+CHUNK_SIZES = [64 << 10, 1 << 20]
+CONCURRENCY = [1, 4]
+
+
+def start_server(cls, port, *args, mode=None, data_port=None):
+    attrs = "{}.default_port = {}".format(cls.__name__, port)
+    if data_port:
+        attrs += "; {}.data_port = {}".format(cls.__name__, data_port)
+    code = ("import sys; sys.path.insert(0, {!r}); from {} import {}; {}; "
+            "{}.server(*{!r}, mode={!r})").format(
+                os.path.dirname(os.path.abspath(__file__)), cls.__module__,
+                cls.__name__, attrs, cls.__name__, args, mode)
+    return subprocess.Popen(
+        [sys.executable, "-c", code],
+        stdout=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def latency(func, n):
+    times = np.empty(n)
+    for i in range(n):
+        st = timer()
+        func()
+        times[i] = timer() - st
+    p50, p99 = np.percentile(times, [50, 99])
+    return {"p50": p50, "p99": p99, "mean": times.mean(), "samples": n}
+
+
+def throughput(worker, size, chunk_size, concurrency, repeat):
+    times = np.empty(repeat)
+    for i in range(repeat):
+        st = timer()
+        rprocs = [
+            worker.async_call(
+                "send_to", data=Data(size, chunk_size=chunk_size),
+                target_addr="127.0.0.1") for _ in range(concurrency)
+        ]
+        for rproc in rprocs:
+            rproc.join()
+        times[i] = timer() - st
+    p50 = np.percentile(times, 50)
+    return {
+        "p50": p50,
+        "rate": bin_format(size * concurrency / p50, "MB"),
+        "samples": repeat,
+    }
+
+
+def suspend_resume(worker, n):
+    rproc = worker.async_call("execute", task=Task(3600))
+    rproc.wait_for_init()
+    suspend = np.empty(n)
+    resume = np.empty(n)
+    for i in range(n):
+        st = timer()
+        worker.suspend(rproc)
+        suspend[i] = timer() - st
+        st = timer()
+        worker.resume(rproc)
+        resume[i] = timer() - st
+    os.kill(rproc.remote_pid, signal.SIGKILL)
+    return {
+        "suspend_p50": np.percentile(suspend, 50),
+        "suspend_p99": np.percentile(suspend, 99),
+        "resume_p50": np.percentile(resume, 50),
+        "resume_p99": np.percentile(resume, 99),
+        "samples": n,
+    }
+
+
+def provisioning(num, boot_time=0.5, api_latency=0.05, repeat=1):
+    times = np.empty(repeat)
+    for i in range(repeat):
+        backend = FakeEC2Backend(boot_time, api_latency)
+        cluster = Cluster("ami-bench", "sg-bench", backend=backend)
+        st = timer()
+        for vid in cluster.create_vms(num, "c4.large"):
+            cluster.vm_ip(vid)
+            cluster.vm_private_ip(vid)
+        times[i] = timer() - st
+    return {
+        "p50": np.percentile(times, 50),
+        "api_calls": sum(backend.calls.values()),
+        "samples": repeat,
+    }
+
+
+def run_benchmarks(port=20000, mode=None, samples=1000, repeat=3,
+                   sizes=SIZES, chunk_sizes=CHUNK_SIZES,
+                   concurrency=CONCURRENCY):
+    servers = [
+        start_server(Worker, port, mode=mode, data_port=port + 2),
+        start_server(Monitor, port + 1, os.getcwd(), mode=mode),
+    ]
+    try:
+        worker = Worker.client("127.0.0.1", port)
+        monitor = Monitor.client("127.0.0.1", port + 1)
+        results = {
+            "rpc.hello": latency(lambda: worker.hello(), samples),
+            "rpc.monitor_hello": latency(lambda: monitor.hello(), samples),
+            "rpc.execute": latency(lambda: worker.execute(task=Task(0)),
+                                   max(1, samples // 10)),
+            "rpc.suspend_resume": suspend_resume(worker,
+                                                 max(1, samples // 10)),
+        }
+        results["ec2.provision.x64"] = provisioning(64, repeat=repeat)
+        for size in sizes:
+            for chunk_size in chunk_sizes:
+                for n in concurrency:
+                    name = "send_to.{:.0f}MB.{:.0f}KB.x{}".format(
+                        bin_format(size, "MB"), bin_format(chunk_size, "KB"),
+                        n)
+                    results[name] = throughput(worker, size, chunk_size, n,
+                                               repeat)
+        return {
+            "meta": {
+                "mode": mode or Worker.server_mode,
+                "python": sys.version.split()[0],
+                "cpus": os.cpu_count(),
+            },
+            "results": results,
+        }
+    finally:
+        for server in servers:
+            stop_server(server)
+
+
+def compare(current, baseline, threshold=0.1):
+    regressions = []
+    for name, metrics in sorted(current["results"].items()):
+        for metric, value in sorted(metrics.items()):
+            base = baseline["results"].get(name, {}).get(metric)
+            if metric == "samples" or not base:
+                continue
+            change = (value - base) / base
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            regressed = change > threshold
+            print("{:<36}{:<14}{:>12.6g}{:>12.6g}{:>+9.1%}{}".format(
+                name, metric, base, value, change,
+                "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark RPC latency and transfer throughput on "
+        "loopback")
+    parser.add_argument("-p", "--port", type=int, default=20000,
+                        help="first of three consecutive ports to use")
+    parser.add_argument("-m", "--mode", help="RPC server mode")
+    parser.add_argument("-n", "--samples", type=int, default=1000,
+                        help="calls per latency benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per throughput benchmark")
+    parser.add_argument("--quick", action="store_true",
+                        help="small payloads and few samples")
+    parser.add_argument("-o", "--output", help="write results to a .json file")
+    parser.add_argument("-b", "--baseline",
+                        help="compare against results stored in a .json file")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="relative change reported as a regression")
+    args = parser.parse_args()
+    if args.quick:
+        kwargs = {"samples": 100, "repeat": 1, "sizes": [1 << 20],
+                  "concurrency": [1]}
+    else:
+        kwargs = {"samples": args.samples, "repeat": args.repeat}
+    results = run_benchmarks(args.port, args.mode, **kwargs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
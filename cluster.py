@@ -1,8 +1,124 @@
 import boto3
+import atexit
+import os
+import os.path
+import subprocess
+import sys
+from collections import Counter
+from itertools import count
 from gevent import pool, sleep
+from time import time
 from worker import Worker
 from monitor import Monitor
 
+PENDING = {"Code": 0, "Name": "pending"}
+RUNNING = {"Code": 16, "Name": "running"}
+
+
+class EC2Backend(object):
+    poll_interval = 1
+
+    def run_instances(self, ami, vm_type, num, key_name, placement, sgroups):
+        raise NotImplementedError
+
+    def describe_instances(self, vids=None, filters=()):
+        raise NotImplementedError
+
+    def wait_running(self, vids):
+        while True:
+            instances = self.describe_instances(vids)
+            if all(i["State"]["Code"] == RUNNING["Code"] for i in instances):
+                return instances
+            sleep(self.poll_interval)
+
+
+class Boto3Backend(EC2Backend):
+    def __init__(self, region):
+        self.client = boto3.client("ec2", region_name=region)
+
+    def run_instances(self, ami, vm_type, num, key_name, placement, sgroups):
+        res = self.client.run_instances(
+            ImageId=ami,
+            InstanceType=vm_type,
+            MinCount=num,
+            MaxCount=num,
+            KeyName=key_name,
+            Placement=placement,
+            SecurityGroupIds=sgroups)
+        return [i["InstanceId"] for i in res["Instances"]]
+
+    def describe_instances(self, vids=None, filters=()):
+        kwargs = {"Filters": list(filters)}
+        if vids:
+            kwargs["InstanceIds"] = list(vids)
+        paginator = self.client.get_paginator("describe_instances")
+        return [
+            i for page in paginator.paginate(**kwargs)
+            for r in page["Reservations"] for i in r["Instances"]
+        ]
+
+    def wait_running(self, vids):
+        self.client.get_waiter("instance_running").wait(
+            InstanceIds=list(vids),
+            WaiterConfig={"Delay": 5, "MaxAttempts": 120})
+        return self.describe_instances(vids)
+
+
+class FakeEC2Backend(EC2Backend):
+    # Keeps instances in memory and answers after a simulated API latency;
+    # instances turn running boot_time seconds after launch.
+    FILTER_KEYS = {
+        "instance-id": lambda i: i["InstanceId"],
+        "instance-state-name": lambda i: i["State"]["Name"],
+        "image-id": lambda i: i["ImageId"],
+        "instance-type": lambda i: i["InstanceType"],
+    }
+
+    def __init__(self, boot_time=0, latency=0, poll_interval=0.1):
+        self.boot_time = boot_time
+        self.latency = latency
+        self.poll_interval = poll_interval
+        self.instances = {}
+        self.ready_at = {}
+        self.ids = count(1)
+        self.calls = Counter()
+
+    def call(self, name):
+        self.calls[name] += 1
+        sleep(self.latency)
+
+    def run_instances(self, ami, vm_type, num, key_name, placement, sgroups):
+        self.call("run_instances")
+        vids = []
+        for _ in range(num):
+            n = next(self.ids)
+            vid = "i-{:017x}".format(n)
+            self.instances[vid] = {
+                "InstanceId": vid,
+                "ImageId": ami,
+                "InstanceType": vm_type,
+                "State": PENDING,
+                "PublicDnsName": "",
+                "PrivateIpAddress": "10.0.{}.{}".format(n // 256, n % 256),
+            }
+            self.ready_at[vid] = time() + self.boot_time
+            vids.append(vid)
+        return vids
+
+    def describe_instances(self, vids=None, filters=()):
+        self.call("describe_instances")
+        now = time()
+        for vid, instance in self.instances.items():
+            if instance["State"] is PENDING and self.ready_at[vid] <= now:
+                instance["State"] = RUNNING
+                instance["PublicDnsName"] = "127.0.0.1"
+        instances = [self.instances[vid] for vid in vids
+                     ] if vids else list(self.instances.values())
+        for f in filters:
+            key = self.FILTER_KEYS[f["Name"]]
+            instances = [i for i in instances if key(i) in f["Values"]]
+        return [dict(i) for i in instances]
+
 
 class Cluster(object):
     def __init__(self,
@@ -10,40 +126,49 @@ class Cluster(object):
                  sgroup,
                  region="ap-southeast-1",
                  pgroup=None,
-                 verbose=False):
+                 verbose=False,
+                 backend=None):
         self.ami = ami
         self.sg = sgroup
         self.pg = pgroup
-        self.ec2 = boto3.resource("ec2", region_name=region)
+        self.backend = backend or Boto3Backend(region)
+        self.instances = {}
         self.verbose = verbose
 
+    def refresh(self, vids=None, filters=()):
+        instances = self.backend.describe_instances(vids, filters)
+        for instance in instances:
+            self.instances[instance["InstanceId"]] = instance
+        return instances
+
+    # Cached descriptions serve the addresses. State changes under them, so
+    # readiness is always asked of the backend.
+    def instance(self, vid):
+        if vid not in self.instances:
+            self.refresh([vid])
+        return self.instances[vid]
+
     def launch_vms(self, vm_type="t2.micro", vm_num=1):
         placement = {"GroupName": self.pg} if not vm_type.startswith("t2.") else {}
-        vms = self.ec2.create_instances(
-            ImageId=self.ami,
-            InstanceType=vm_type,
-            MinCount=vm_num,
-            MaxCount=vm_num,
-            KeyName="research",
-            Placement=placement,
-            SecurityGroupIds=[self.sg])
-        vids = [vm.instance_id for vm in vms]
-        while not all(self.vm_is_ready(vid) for vid in vids):
-            sleep(1)
+        vids = self.backend.run_instances(self.ami, vm_type, vm_num,
+                                          "research", placement, [self.sg])
+        for instance in self.backend.wait_running(vids):
+            self.instances[instance["InstanceId"]] = instance
         return vids
 
     def vm_is_ready(self, vid):
-        return self.ec2.Instance(vid).state["Code"] == 16
+        self.refresh([vid])
+        return self.instances[vid]["State"]["Code"] == RUNNING["Code"]
 
     def vm_ip(self, vid):
-        return self.ec2.Instance(vid).public_dns_name
+        return self.instance(vid)["PublicDnsName"]
 
     def vm_private_ip(self, vid):
-        return self.ec2.Instance(vid).private_ip_address
+        return self.instance(vid)["PrivateIpAddress"]
 
-    def existing_vms(self, vm_type, num=20):
+    def existing_vms(self, vm_type, num=20, exclude=()):
         vms = []
-        for vm in self.ec2.instances.filter(Filters=[{
+        for vm in self.refresh(filters=[{
                 "Name":
                 "instance-state-name",
                 'Values': ["running"]
@@ -54,14 +179,16 @@ class Cluster(object):
                 "Name": "instance-type",
                 "Values": [vm_type]
         }]):
-            if self.verbose: print("Existing VM found:", vm.instance_id)
-            vms.append(vm.instance_id)
+            if vm["InstanceId"] in exclude:
+                continue
+            if self.verbose: print("Existing VM found:", vm["InstanceId"])
+            vms.append(vm["InstanceId"])
             if len(vms) == num:
                 break
         return vms
 
-    def create_vms(self, num, vm_type):
-        vms = self.existing_vms(vm_type, num)
+    def create_vms(self, num, vm_type, exclude=()):
+        vms = self.existing_vms(vm_type, num, exclude)
         if len(vms) < num:
             if self.verbose:
                 print("{} new VMs to launch".format(num - len(vms)))
@@ -83,11 +210,129 @@ class Cluster(object):
         monitor = self.get_monitor_from_vid(vid)
         worker = Worker.client(ip, keep_alive=False)
         worker.private_ip = self.vm_private_ip(vid)
+        worker.vid = vid
+        worker.monitor = monitor
         return worker
 
-    def create_workers(self, num, vm_type="t2.micro"):
+    def create_workers(self, num, vm_type="t2.micro", exclude=()):
         return pool.Group().map(self.get_worker_from_vid,
-                                self.create_vms(num, vm_type))
+                                self.create_vms(num, vm_type, exclude))
+
+
+class LocalCluster(object):
+    # Runs workers as local processes on loopback, each on a fresh pair of
+    # ports, with their data plane shaped to the given rates in bytes/s.
+    ports = count(11000, 2)
+
+    def __init__(self, upload_rate=None, download_rate=None, verbose=False):
+        self.upload_rate = upload_rate
+        self.download_rate = download_rate
+        self.verbose = verbose
+        self.procs = {}
+        atexit.register(self.shutdown)
+
+    def start_worker(self, vid):
+        port = next(self.ports)
+        cmd = [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "worker.py"), "--port",
+            str(port), "--data-port",
+            str(port + 1)
+        ]
+        if self.upload_rate:
+            cmd += ["--upload-rate", str(self.upload_rate)]
+        if self.download_rate:
+            cmd += ["--download-rate", str(self.download_rate)]
+        if self.verbose: print("Starting local worker on port", port)
+        self.stop_worker(vid)
+        self.procs[vid] = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, start_new_session=True)
+        worker = Worker.client("127.0.0.1", port)
+        worker.private_ip = "127.0.0.1:{}".format(port + 1)
+        worker.vid = vid
+        worker.monitor = None
+        return worker
+
+    def create_workers(self, num, vm_type=None, exclude=()):
+        vids = [vid for vid in range(num + len(exclude))
+                if vid not in exclude][:num]
+        return pool.Group().map(self.start_worker, vids)
+
+    # Isolated calls lead process groups of their own but stay in the
+    # session the worker was started in, so the whole session is killed.
+    def stop_worker(self, vid):
+        proc = self.procs.pop(vid, None)
+        if proc:
+            subprocess.run(["pkill", "-9", "-s", str(proc.pid)])
+            proc.wait()
+
+    def shutdown(self):
+        for vid in list(self.procs):
+            self.stop_worker(vid)
+
+
+def local_revision(path=os.path.dirname(os.path.abspath(__file__))):
+    res = subprocess.run(["git", "-C", path, "rev-parse", "HEAD"],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL)
+    return res.stdout.decode().strip() or None
+
+
+class WorkerPool(object):
+    # Keeps workers connected across runs. Monitors are only asked to update
+    # when the local checkout changed revision, and restart their worker only
+    # if that moved their own checkout too.
+    def __init__(self, cluster, vm_type="t2.micro"):
+        self.cluster = cluster
+        self.vm_type = vm_type
+        self.workers = []
+        self.revision = local_revision()
+
+    def alive(self, worker):
+        try:
+            return worker.hello() == "Hello!"
+        except Exception:
+            return False
+
+    def sync(self):
+        revision = local_revision()
+        if revision == self.revision:
+            return
+        pool.Group().map(lambda w: w.monitor.start_worker(update=True),
+                         [w for w in self.workers if w.monitor])
+        self.revision = revision
+
+    def acquire(self, num):
+        self.sync()
+        alive = pool.Group().map(self.alive, self.workers)
+        self.workers = [w for w, ok in zip(self.workers, alive) if ok]
+        if len(self.workers) < num:
+            self.workers.extend(
+                self.cluster.create_workers(num - len(self.workers),
+                                            self.vm_type,
+                                            [w.vid for w in self.workers]))
+        return self.workers[:num]
+
+    # The offset of a worker's clock from ours is read halfway through the
+    # fastest of a few round trips, once per worker.
+    def sync_clock(self, worker, samples=8):
+        best = None
+        for _ in range(samples):
+            st = time()
+            remote = worker.clock()
+            rtt = time() - st
+            if best is None or rtt < best[0]:
+                best = (rtt, remote - st - rtt / 2)
+        worker.clock_offset = best[1]
+
+    def assign(self, machines):
+        workers = self.acquire(len(machines))
+        pool.Group().map(
+            self.sync_clock,
+            [w for w in workers if not hasattr(w, "clock_offset")])
+        for worker, machine in zip(workers, machines):
+            machine.worker = worker
 
 
 if __name__ == "__main__":
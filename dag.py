@@ -0,0 +1,180 @@
+import numpy as np
+
+
+class TaskGraph(object):
+    def __init__(self, tids, runtime, resources, planned_st, machine,
+                 succ_ptr, succ_idx, out_ptr, comm_dst, data_size,
+                 comm_planned_st, comm_planned_ft):
+        self.tids = tids
+        self.runtime = runtime
+        self.resources = resources
+        self.planned_st = planned_st
+        self.machine = machine
+        self.succ_ptr = succ_ptr
+        self.succ_idx = succ_idx
+        self.out_ptr = out_ptr
+        self.comm_dst = comm_dst
+        self.data_size = data_size
+        self.comm_planned_st = comm_planned_st
+        self.comm_planned_ft = comm_planned_ft
+        self.demands = resources.copy()
+        self.demands[:, 0] = np.trunc(resources[:, 0] * 1000)
+        self.comm_src = np.repeat(
+            np.arange(self.num_tasks, dtype=np.int64), np.diff(out_ptr))
+        self.remaining_prevs = self.initial_prevs()
+        self.machines = None
+        self.tasks = None
+        self.comms = None
+
+    @property
+    def num_tasks(self):
+        return len(self.tids)
+
+    @property
+    def num_comms(self):
+        return len(self.comm_dst)
+
+    @property
+    def succ_src(self):
+        return np.repeat(
+            np.arange(self.num_tasks, dtype=np.int64), np.diff(self.succ_ptr))
+
+    def initial_prevs(self):
+        return (np.bincount(self.succ_idx, minlength=self.num_tasks) +
+                np.bincount(self.comm_dst, minlength=self.num_tasks)).astype(
+                    np.int32)
+
+    @classmethod
+    def from_raw(cls, raw_machines):
+        builder = TaskGraphBuilder()
+        for raw_machine in raw_machines:
+            builder.add_machine(raw_machine)
+        return builder.build()
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in ARRAY_FIELDS}
+
+    def bind(self, task_cls, comm_cls, machines):
+        self.machines = machines
+        task_view = view_class(task_cls, TASK_FIELDS)
+        comm_view = view_class(comm_cls, COMM_FIELDS)
+        self.tasks = [task_view.at(self, i) for i in range(self.num_tasks)]
+        self.comms = [comm_view.at(self, i) for i in range(self.num_comms)]
+        return self.tasks
+
+
+class TaskGraphBuilder(object):
+    def __init__(self):
+        self.num_machines = 0
+        self.tids = []
+        self.runtime = []
+        self.resources = []
+        self.planned_st = []
+        self.machine = []
+        self.succs = []
+        self.outputs = []
+
+    def add_machine(self, raw_machine):
+        mid = self.num_machines
+        self.num_machines += 1
+        for raw_task in raw_machine:
+            self.tids.append(raw_task["id"])
+            self.runtime.append(raw_task["runtime"])
+            self.resources.append(raw_task["resources"])
+            self.planned_st.append(raw_task["start_time"])
+            self.machine.append(mid)
+            self.succs.append(raw_task["succs"])
+            self.outputs.append(
+                [(c["to_task"], c["data_size"], c["start_time"],
+                  c["finish_time"]) for c in raw_task["output"]])
+
+    def build(self):
+        index = {tid: i for i, tid in enumerate(self.tids)}
+        succ_ptr = np.zeros(len(self.tids) + 1, dtype=np.int64)
+        succ_ptr[1:] = np.cumsum([len(s) for s in self.succs])
+        succ_idx = np.array(
+            [index[sid] for s in self.succs for sid in s], dtype=np.int64)
+        out_ptr = np.zeros(len(self.tids) + 1, dtype=np.int64)
+        out_ptr[1:] = np.cumsum([len(o) for o in self.outputs])
+        comms = [c for o in self.outputs for c in o]
+        return TaskGraph(
+            tids=np.array(self.tids),
+            runtime=np.array(self.runtime, dtype=np.float64),
+            resources=np.array(self.resources,
+                               dtype=np.float64).reshape(-1, 2),
+            planned_st=np.array(self.planned_st, dtype=np.float64),
+            machine=np.array(self.machine, dtype=np.int32),
+            succ_ptr=succ_ptr,
+            succ_idx=succ_idx,
+            out_ptr=out_ptr,
+            comm_dst=np.array([index[c[0]] for c in comms], dtype=np.int64),
+            data_size=np.array([c[1] for c in comms]),
+            comm_planned_st=np.array([c[2] for c in comms], dtype=np.float64),
+            comm_planned_ft=np.array([c[3] for c in comms],
+                                     dtype=np.float64))
+
+
+ARRAY_FIELDS = ("tids", "runtime", "resources", "planned_st", "machine",
+                "succ_ptr", "succ_idx", "out_ptr", "comm_dst", "data_size",
+                "comm_planned_st", "comm_planned_ft")
+
+
+def _view_at(cls, graph, idx):
+    view = cls.__new__(cls)
+    view.graph = graph
+    view.idx = idx
+    return view
+
+
+def _set_remaining_prevs(self, value):
+    self.graph.remaining_prevs[self.idx] = value
+
+
+TASK_FIELDS = {
+    "tid":
+    property(lambda self: self.graph.tids[self.idx].item()),
+    "runtime":
+    property(lambda self: self.graph.runtime[self.idx].item()),
+    "resources":
+    property(lambda self: self.graph.demands[self.idx]),
+    "planned_st":
+    property(lambda self: self.graph.planned_st[self.idx].item()),
+    "machine":
+    property(lambda self: self.graph.machines[self.graph.machine[self.idx]]),
+    "succs":
+    property(lambda self: [
+        self.graph.tasks[i] for i in self.graph.succ_idx[
+            self.graph.succ_ptr[self.idx]:self.graph.succ_ptr[self.idx + 1]]
+    ]),
+    "outputs":
+    property(lambda self: self.graph.comms[
+        self.graph.out_ptr[self.idx]:self.graph.out_ptr[self.idx + 1]]),
+    "remaining_prevs":
+    property(lambda self: self.graph.remaining_prevs[self.idx].item(),
+             _set_remaining_prevs),
+}
+
+COMM_FIELDS = {
+    "from_task":
+    property(lambda self: self.graph.tasks[self.graph.comm_src[self.idx]]),
+    "to_task":
+    property(lambda self: self.graph.tasks[self.graph.comm_dst[self.idx]]),
+    "data_size":
+    property(lambda self: self.graph.data_size[self.idx].item()),
+    "planned_st":
+    property(lambda self: self.graph.comm_planned_st[self.idx].item()),
+    "planned_ft":
+    property(lambda self: self.graph.comm_planned_ft[self.idx].item()),
+}
+
+_view_classes = {}
+
+
+def view_class(cls, fields):
+    if cls not in _view_classes:
+        namespace = dict(fields)
+        namespace["__slots__"] = ("graph", "idx")
+        namespace["__module__"] = cls.__module__
+        namespace["at"] = classmethod(_view_at)
+        _view_classes[cls] = type(cls.__name__, (cls, ), namespace)
+    return _view_classes[cls]
@@ -1,36 +1,89 @@
 #!/usr/bin/env python3
 
+import gevent
 import scheduler as s
 import worker as w
-from cluster import Cluster
-from gevent import sleep
+from cluster import Cluster, LocalCluster, WorkerPool
+from collections import Counter
 from time import time
 
 
-class EC2Task(s.Task):
-    def execute(self):
-        self.machine.worker.execute(task=w.Task(self.runtime))
+class Staged(object):
+    __slots__ = ()
 
+    # A call staged ahead of its start is forked on the worker in the
+    # background, so the scheduler never waits on a pool slot for it, and
+    # then waits there for a release. An unstaged call is made when
+    # started. Either way the worker holds the call until start_at, on its
+    # own clock, and reports when it actually started.
+    def stage(self, start_at):
+        self.staging = gevent.spawn(
+            self.worker.async_call, self.func, start_at=start_at, gated=True,
+            **self.arguments())
 
-class EC2Comm(s.Comm):
-    def execute(self):
-        self.rproc = self.from_task.machine.worker.async_call(
-            "send_to",
-            data=w.Data(self.data_size),
-            target_addr=self.to_task.machine.worker.private_ip)
+    def execute(self, start_at=None):
+        if self.staging is not None:
+            self.rproc = self.staging.get()
+        else:
+            self.rproc = self.worker.async_call(
+                self.func, start_at=start_at, **self.arguments())
+        self.attached()
+        if self.staging is not None:
+            self.worker.control(self.rproc, "release")
         self.rproc.join()
-        # print(self, self.rproc.value.statistic)
+        return self.rproc.value
 
-    def wait_for_init(self):
-        while not hasattr(self, "rproc"):
-            sleep(0.01)
+    def attached(self):
+        pass
+
+
+class EC2Task(Staged, s.Task):
+    __slots__ = ("rproc", "staging", "dispatched")
+    func = "execute"
+
+    @property
+    def worker(self):
+        return self.machine.worker
+
+    def arguments(self):
+        if getattr(self.worker, "synthetic_load", False):
+            task = w.Task(self.runtime, int(self.resources[0]),
+                          float(self.resources[1]))
+        else:
+            task = w.Task(self.runtime)
+        return {"task": task}
+
+
+class EC2Comm(Staged, s.Comm):
+    __slots__ = ("rproc", "staging", "dispatched", "paused")
+    func = "send_to"
+
+    @property
+    def worker(self):
+        return self.from_task.machine.worker
+
+    def arguments(self):
+        return {
+            "data": w.Data(self.data_size),
+            "target_addr": self.to_task.machine.worker.private_ip,
+        }
+
+    # Both ends of a comm may suspend it, so the transfer runs only while
+    # neither does. A comm suspended before its call exists is paused as
+    # soon as the call is made.
+    def attached(self):
+        if self.paused:
+            self.worker.control(self.rproc, "pause_transfer")
 
     def suspend(self):
-        self.wait_for_init()
-        self.from_task.machine.worker.suspend(self.rproc)
+        self.paused += 1
+        if self.paused == 1 and self.rproc:
+            self.worker.control(self.rproc, "pause_transfer")
 
     def resume(self):
-        self.from_task.machine.worker.resume(self.rproc)
+        self.paused -= 1
+        if not self.paused and self.rproc:
+            self.worker.control(self.rproc, "resume_transfer")
 
 
 class EC2Scheduler(s.Scheduler):
@@ -40,22 +93,197 @@ class EC2Scheduler(s.Scheduler):
     sgroup = "sg-c86bc4ae"
     region = "ap-southeast-1"
     pgroup = "wino"
+    pools = {}
 
-    def __init__(self, vm_type):
+    # Calls are staged stage_ahead seconds before their planned start, once
+    # their dependencies are met or all but one that is under way, and
+    # started start_ahead seconds before it. At most max_staged calls wait
+    # on a worker at a time, which leaves its pool slots for the others; a
+    # stage_ahead of 0 turns staging off.
+    max_staged = 64
+
+    def __init__(self, vm_type, synthetic_load=False, stage_ahead=0.25,
+                 start_ahead=0.02, **kwargs):
         self.vm_type = vm_type
-        super().__init__()
+        self.synthetic_load = synthetic_load
+        self.stage_ahead = stage_ahead
+        self.start_ahead = start_ahead
+        self.telemetry = None
+        self.origin = 0
+        super().__init__(**kwargs)
+
+    def create_cluster(self, vm_type, **kwargs):
+        return Cluster(self.ami, self.sgroup, self.region, self.pgroup, **kwargs)
+
+    # telemetry, a tracer.Telemetry, streams the monitors' samples for the
+    # length of the run.
+    def run(self, log="d", trace=None, telemetry=None, **kwargs):
+        self.telemetry = telemetry
+        try:
+            return super().run(log, trace, **kwargs)
+        finally:
+            self.telemetry = None
+            if telemetry:
+                telemetry.stop()
+
+    def init_run(self, log, trace=None):
+        super().init_run(log, trace)
+        self.staging = s.ReadyQueue()
+        self.candidates = set()
+        self.staged_calls = Counter()
+        for task in self.tasks.values():
+            task.rproc = task.staging = None
+            task.dispatched = False
+            for comm in task.outputs:
+                comm.rproc = comm.staging = None
+                comm.dispatched = False
+                comm.paused = 0
+        if self.simulated:
+            return
+        self.nearly_ready(self.tasks.values())
+        self.origin = time() - self.now()
+        if self.telemetry:
+            self.telemetry.start(self.machines, self.origin)
+
+    def worker_time(self, worker, t):
+        return t + self.origin + worker.clock_offset
+
+    def run_time(self, worker, t):
+        return t - worker.clock_offset - self.origin
+
+    def dispatch_time(self):
+        if self.simulated:
+            return self.now()
+        return self.now() + self.start_ahead
+
+    def candidate(self, obj):
+        if obj not in self.candidates:
+            self.candidates.add(obj)
+            self.staging.add(obj)
+
+    def nearly_ready(self, tasks):
+        for task in tasks:
+            if task.remaining_prevs <= 1:
+                self.candidate(task)
+
+    def task_started(self, task):
+        super().task_started(task)
+        if not self.simulated:
+            for comm in task.outputs:
+                self.candidate(comm)
+            self.nearly_ready(task.succs)
+
+    def task_finished(self, task):
+        super().task_finished(task)
+        if not self.simulated:
+            self.nearly_ready(task.succs)
+
+    def comm_started(self, comm):
+        super().comm_started(comm)
+        if not self.simulated:
+            self.nearly_ready([comm.to_task])
+
+    def comm_finished(self, comm):
+        super().comm_finished(comm)
+        if not self.simulated:
+            self.nearly_ready([comm.to_task])
+
+    def start_task(self, task):
+        task.dispatched = True
+        super().start_task(task)
+
+    def start_comm(self, comm):
+        comm.dispatched = True
+        super().start_comm(comm)
+
+    def schedule(self):
+        if self.stage_ahead and not self.simulated:
+            horizon = self.now() + max(self.stage_ahead, self.start_ahead)
+            for obj in self.staging.release(horizon):
+                worker = obj.worker
+                if (not obj.dispatched
+                        and self.staged_calls[worker] < self.max_staged):
+                    self.staged_calls[worker] += 1
+                    obj.stage(self.worker_time(worker, obj.planned_st))
+        super().schedule()
+
+    def next_dispatch_time(self):
+        next_time = super().next_dispatch_time()
+        stage_time = self.staging.next_time()
+        if self.stage_ahead and not self.simulated and stage_time is not None:
+            stage_time -= self.stage_ahead - self.start_ahead
+            if next_time is None or stage_time < next_time:
+                next_time = stage_time
+        return next_time
+
+    # Trace records take the start the worker reported, not the dispatch.
+    def exec_task(self, task):
+        self.task_started(task)
+        worker = task.worker
+        result = task.execute(self.worker_time(worker, task.planned_st))
+        if task.staging is not None:
+            self.staged_calls[worker] -= 1
+        if self.tracer and result:
+            self.tracer.start(task, self.run_time(worker, result.start_time))
+        self.task_finished(task)
+
+    def exec_comm(self, comm):
+        self.comm_started(comm)
+        worker = comm.worker
+        result = comm.execute(self.worker_time(worker, comm.planned_st))
+        if comm.staging is not None:
+            self.staged_calls[worker] -= 1
+        if self.tracer and result:
+            self.tracer.start(comm, self.run_time(worker, result.start_time))
+        self.comm_finished(comm)
+
+    def prepare_workers(self, **kwargs):
+        self.assign_workers(self.vm_type, self.machines, **kwargs)
+        for machine in self.machines:
+            machine.worker.synthetic_load = self.synthetic_load
+
+    # Pools live for the whole process, so consecutive runs on the same VM
+    # type reuse the workers of the previous one.
+    def assign_workers(self, vm_type, machines, **kwargs):
+        key = (type(self).__name__, vm_type)
+        if key not in self.pools:
+            self.pools[key] = WorkerPool(
+                self.create_cluster(vm_type, **kwargs), vm_type)
+        self.pools[key].assign(machines)
+
+
+class LocalScheduler(EC2Scheduler):
+    # Runs against worker processes on this host, with each machine's worker
+    # shaped to that machine's upload and download rates (Comm.rate unless
+    # the schedule's bandwidth is given). Machines sharing a pair of rates
+    # share a VM type, and so a pool of workers.
+    def __init__(self, vm_type="local", **kwargs):
+        super().__init__(vm_type, **kwargs)
+        self.vm_rates = {}
+
+    def link_rates(self):
+        if self.bandwidth is None:
+            return [(self.comm_cls.rate, self.comm_cls.rate)] * len(
+                self.machines)
+        return self.link_capacities()
+
+    def create_cluster(self, vm_type, **kwargs):
+        return LocalCluster(*self.vm_rates[vm_type], **kwargs)
 
     def prepare_workers(self, **kwargs):
-        cluster = Cluster(self.ami, self.sgroup, self.region, self.pgroup, **kwargs)
-        workers = cluster.create_workers(len(self.machines), self.vm_type)
-        for worker, machine in zip(workers, self.machines):
-            machine.worker = worker
+        groups = {}
+        for machine, rates in zip(self.machines, self.link_rates()):
+            vm_type = "local-{:.0f}-{:.0f}".format(*rates)
+            self.vm_rates[vm_type] = rates
+            groups.setdefault(vm_type, []).append(machine)
+        for vm_type, machines in groups.items():
+            self.assign_workers(vm_type, machines, **kwargs)
+        for machine in self.machines:
+            machine.worker.synthetic_load = self.synthetic_load
 
 
 if __name__ == "__main__":
-    from sys import argv
-    for path in argv[1:]:
-        s = EC2Scheduler("c4.large")
-        # s = EC2Scheduler("t2.micro")
-        s.load(path)
-        s.run(log="p")
+    from batch import main
+    main(EC2Scheduler, mode="run", jobs=1, vm_type="c4.large")
+    # main(EC2Scheduler, mode="run", jobs=1, vm_type="t2.micro")
+    # main(LocalScheduler, mode="run", jobs=1)
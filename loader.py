@@ -0,0 +1,186 @@
+import json
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+import numpy as np
+from dag import TaskGraph, TaskGraphBuilder
+
+MAGIC = b"WINOSCH1"
+HEADER_STRUCT = ">Q"
+HEADER_LEN = struct.calcsize(HEADER_STRUCT)
+ALIGNMENT = 64
+CHUNK_SIZE = 1 << 16
+SCHEDULE_SUFFIXES = (".schedule", ".wino")
+DEFAULT_CACHE_DIR = os.environ.get(
+    "WINO_CACHE_DIR", os.path.expanduser("~/.cache/wino"))
+
+
+class StreamReader(object):
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(max(self.chunk_size, len(self.buf)))
+        if not chunk:
+            self.eof = True
+        self.buf += chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of schedule file")
+            self.fill()
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError("Expected {!r} at offset {} of schedule file".
+                             format(c, self.pos))
+        self.pos += 1
+
+    def skip_separator(self, end):
+        c = self.peek()
+        if c == ",":
+            self.pos += 1
+            c = self.peek()
+        if c == end:
+            self.pos += 1
+            return True
+        return False
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def parse_schedule(f, on_machine, chunk_size=CHUNK_SIZE):
+    reader = StreamReader(f, chunk_size)
+    meta = {}
+    reader.expect("{")
+    while not reader.skip_separator("}"):
+        key = reader.decode()
+        reader.expect(":")
+        if key == "machines":
+            reader.expect("[")
+            num_machines = 0
+            while not reader.skip_separator("]"):
+                on_machine(reader.decode())
+                num_machines += 1
+            meta["num_machines"] = num_machines
+        else:
+            meta[key] = reader.decode()
+    return meta
+
+
+def read_schedule(path):
+    builder = TaskGraphBuilder()
+    with open(path) as f:
+        meta = parse_schedule(f, builder.add_machine)
+    return meta, builder.build()
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_compiled(path, meta, graph):
+    arrays = [(name, np.ascontiguousarray(array))
+              for name, array in graph.arrays().items()]
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        if array.dtype.hasobject:
+            raise ValueError("Cannot compile {} of dtype {}".format(
+                name, array.dtype))
+        layout[name] = [array.dtype.str, array.shape, offset]
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"meta": meta, "arrays": layout}).encode("utf-8")
+    data_start = _align(len(MAGIC) + HEADER_LEN + len(header))
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack(HEADER_STRUCT, len(header)) + header)
+        for name, array in arrays:
+            f.seek(data_start + layout[name][2])
+            f.write(array.data)
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_compiled(path):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a compiled schedule".format(path))
+    header_len = struct.unpack_from(HEADER_STRUCT, buf, len(MAGIC))[0]
+    header_start = len(MAGIC) + HEADER_LEN
+    header = json.loads(
+        buf[header_start:header_start + header_len].decode("utf-8"))
+    data_start = _align(header_start + header_len)
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count:
+            arrays[name] = np.frombuffer(
+                buf, dtype, count, data_start + offset).reshape(shape)
+        else:
+            arrays[name] = np.empty(shape, dtype)
+    return header["meta"], TaskGraph(**arrays)
+
+
+def content_hash(path):
+    h = hashlib.blake2b(MAGIC, digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compile_schedule(path, cache_dir=DEFAULT_CACHE_DIR):
+    cache_path = os.path.join(cache_dir, content_hash(path) + ".wino")
+    if os.path.exists(cache_path):
+        return load_compiled(cache_path)
+    meta, graph = read_schedule(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_compiled(cache_path, meta, graph)
+    return meta, graph
+
+
+# The schedule's name is its file name without the suffix of its format.
+def schedule_name(path):
+    name = os.path.basename(path)
+    for suffix in SCHEDULE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def load_schedule(path, cache_dir=None):
+    if path.endswith(".wino"):
+        return load_compiled(path)
+    if cache_dir:
+        return compile_schedule(path, cache_dir)
+    return read_schedule(path)
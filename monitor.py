@@ -1,25 +1,124 @@
 #!/usr/bin/env python3
 
 from rpcserver import RPC
-import os.path
+from time import time
+import base64
+import gevent
+import os
+import struct
 import subprocess
 import sys
 
+SAMPLE_STRUCT = "<dfQQQ"
+SAMPLE_LEN = struct.calcsize(SAMPLE_STRUCT)
+
+
+class Sampler(object):
+    # Keeps its /proc files open, so that a sample costs three reads. CPU
+    # use is the number of busy cores since the previous sample, memory the
+    # bytes in use, and rx/tx the byte counters of nic (every NIC but the
+    # loopback when not given).
+    def __init__(self, nic=None):
+        self.nic = nic and nic.encode()
+        self.stat = open("/proc/stat", "rb", buffering=0)
+        self.meminfo = open("/proc/meminfo", "rb", buffering=0)
+        self.netdev = open("/proc/net/dev", "rb", buffering=0)
+        self.cpus = os.cpu_count()
+        self.busy, self.total = self.cpu_times()
+        self.cpu = 0.0
+
+    def close(self):
+        for f in (self.stat, self.meminfo, self.netdev):
+            f.close()
+
+    def read(self, f):
+        f.seek(0)
+        return f.read()
+
+    def cpu_times(self):
+        times = [int(x) for x in self.read(self.stat).split(b"\n", 1)[0]
+                 .split()[1:9]]
+        idle = times[3] + times[4]
+        total = sum(times)
+        return total - idle, total
+
+    def memory(self):
+        info = {}
+        for line in self.read(self.meminfo).splitlines()[:5]:
+            name, value = line.split(b":", 1)
+            info[name] = int(value.split()[0]) << 10
+        return info[b"MemTotal"] - info[b"MemAvailable"]
+
+    def network(self):
+        rx = tx = 0
+        for line in self.read(self.netdev).splitlines()[2:]:
+            name, counters = line.split(b":", 1)
+            name = name.strip()
+            if name == self.nic or (not self.nic and name != b"lo"):
+                counters = counters.split()
+                rx += int(counters[0])
+                tx += int(counters[8])
+        return rx, tx
+
+    def sample(self):
+        busy, total = self.cpu_times()
+        if total > self.total:
+            self.cpu = (busy - self.busy) / (total - self.total) * self.cpus
+            self.busy, self.total = busy, total
+        return (time(), self.cpu, self.memory()) + self.network()
+
 
 class Monitor(RPC):
     default_port = 10001
 
     def __init__(self, path):
         self.path = os.path.abspath(path)
+        self.worker = None
+        self.worker_revision = None
 
-    def start_worker(self, update):
+    def revision(self):
+        res = subprocess.run(["git", "-C", self.path, "rev-parse", "HEAD"],
+                             stdout=subprocess.PIPE)
+        return res.stdout.decode().strip() or None
+
+    # Keeps a running worker unless the checkout moved to another revision,
+    # and tells the caller whether it restarted.
+    def start_worker(self, update, force=False):
         if update:
             subprocess.run(["git", "-C", self.path, "pull"])
+        revision = self.revision()
+        if (not force and self.worker and self.worker.poll() is None
+                and revision == self.worker_revision):
+            return False
         self.stop_worker()
-        subprocess.Popen([os.path.join(self.path, "worker.py")])
+        self.worker = subprocess.Popen([os.path.join(self.path, "worker.py")])
+        self.worker_revision = revision
+        return True
+
+    # Streams packed samples taken every interval, a batch every flush
+    # seconds, for as long as the client keeps reading. Batches are bytes,
+    # or base64 text for a client whose codec cannot carry bytes.
+    def telemetry(self, interval=0.01, flush=0.25, nic=None):
+        binary = self._port.codec.binary
+        sampler = Sampler(nic)
+        buf = bytearray(max(1, round(flush / interval)) * SAMPLE_LEN)
+        next_time = time()
+        try:
+            while True:
+                for offset in range(0, len(buf), SAMPLE_LEN):
+                    next_time = max(next_time + interval, time())
+                    gevent.sleep(next_time - time())
+                    struct.pack_into(SAMPLE_STRUCT, buf, offset,
+                                     *sampler.sample())
+                yield bytes(buf) if binary else base64.b64encode(buf).decode()
+        finally:
+            sampler.close()
 
     def stop_worker(self):
         subprocess.run(["pkill", "-9", "-f", "worker.py"])
+        if self.worker:
+            self.worker.wait()
+            self.worker = None
 
 if __name__ == "__main__":
     Monitor.server(sys.argv[1])
@@ -0,0 +1,103 @@
+from collections import defaultdict
+
+INFINITY = float("inf")
+
+
+class Link(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+
+class Flow(object):
+    __slots__ = ("comm", "links", "remaining", "rate", "paused",
+                 "finish_time")
+
+    def __init__(self, comm, links, size):
+        self.comm = comm
+        self.links = links
+        self.remaining = size
+        self.rate = 0
+        self.paused = 0
+        self.finish_time = INFINITY
+
+
+def max_min_rates(flows):
+    users = defaultdict(list)
+    for flow in flows:
+        for link in flow.links:
+            users[link].append(flow)
+    remaining = {link: link.capacity for link in users}
+    counts = {link: len(flows) for link, flows in users.items()}
+    rates = {}
+    while counts:
+        bottleneck = min(counts, key=lambda l: remaining[l] / counts[l])
+        share = max(remaining[bottleneck] / counts[bottleneck], 0)
+        for flow in users[bottleneck]:
+            if flow in rates:
+                continue
+            rates[flow] = share
+            for link in flow.links:
+                remaining[link] -= share
+                counts[link] -= 1
+                if not counts[link]:
+                    del counts[link]
+    return rates
+
+
+class Network(object):
+    def __init__(self):
+        self.flows = {}
+        self.clock = 0
+        self.dirty = False
+
+    def add_flow(self, comm, links, size):
+        self.flows[comm] = Flow(comm, links, size)
+        self.dirty = True
+
+    def pause(self, comm):
+        flow = self.flows.get(comm)
+        if flow:
+            flow.paused += 1
+            self.dirty = True
+
+    def resume(self, comm):
+        flow = self.flows.get(comm)
+        if flow:
+            flow.paused -= 1
+            self.dirty = True
+
+    def update(self):
+        if not self.dirty:
+            return
+        rates = max_min_rates(
+            [f for f in self.flows.values() if not f.paused])
+        for flow in self.flows.values():
+            flow.rate = rates.get(flow, 0)
+            if not flow.remaining:
+                flow.finish_time = self.clock
+            elif flow.rate > 0:
+                flow.finish_time = self.clock + flow.remaining / flow.rate
+            else:
+                flow.finish_time = INFINITY
+        self.dirty = False
+
+    def next_time(self):
+        self.update()
+        return min((f.finish_time for f in self.flows.values()),
+                   default=INFINITY)
+
+    def advance(self, clock):
+        self.update()
+        elapsed = clock - self.clock
+        finished = []
+        for flow in self.flows.values():
+            if flow.finish_time <= clock:
+                finished.append(flow.comm)
+            else:
+                flow.remaining -= flow.rate * elapsed
+        for comm in finished:
+            del self.flows[comm]
+        if finished:
+            self.dirty = True
+        self.clock = clock
+        return finished
@@ -1,12 +1,28 @@
 import gevent
+import gevent.local
 from gevent import socket
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore, Semaphore
+from gevent.queue import Queue
 import multiprocessing
+import socket as stdsocket
 from functools import partial, wraps
 import json
+import pickle
 import struct
 import os
+import traceback
+import types
 import signal
 from functools import partial
+from itertools import count
+from random import uniform
+from timeit import default_timer as timer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class Remotable(object):
@@ -37,6 +53,17 @@ def safe_recv(sock, len):
         return False
 
 
+def safe_recv_into(sock, view):
+    try:
+        length = sock.recv_into(view)
+        if length:
+            return length
+    except:
+        pass
+    sock.close()
+    return False
+
+
 def safe_send(sock, buf):
     try:
         sock.sendall(buf)
@@ -46,89 +73,526 @@ def safe_send(sock, buf):
         return False
 
 
-def try_connect(sock, addr, times, intervals):
+def isolated(func):
+    func.isolated = True
+    return func
+
+
+MAX_BACKOFF = 2
+
+
+# Retries back off exponentially from interval, sleeping a random fraction
+# of the current delay so that clients restarting together spread out.
+def try_connect(sock, addr, times, interval, max_interval=MAX_BACKOFF):
     while times:
         try:
             sock.connect(addr)
             break
         except Exception:
-            gevent.sleep(intervals)
             times -= 1
+            if times:
+                gevent.sleep(uniform(interval / 2, interval))
+                interval = min(interval * 2, max_interval)
     return times
 
 
-load = json.loads
-dump = json.dumps
+def control_address(pid):
+    return "\0rpc-control-{}".format(pid)
+
+
+class JSONCodec(object):
+    id = 0
+    name = "json"
+    binary = False
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8"), ()
+
+    @staticmethod
+    def loads(buf, buffers):
+        return json.loads(bytes(buf))
+
+
+class MsgpackCodec(object):
+    id = 1
+    name = "msgpack"
+    binary = True
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj), ()
+
+    @staticmethod
+    def loads(buf, buffers):
+        return msgpack.unpackb(buf)
+
+
+class PickleCodec(object):
+    id = 2
+    name = "pickle"
+    binary = True
+
+    @staticmethod
+    def dumps(obj):
+        buffers = []
+        payload = pickle.dumps(obj, 5, buffer_callback=buffers.append)
+        return payload, [b.raw() for b in buffers]
+
+    @staticmethod
+    def loads(buf, buffers):
+        return pickle.loads(buf, buffers=buffers)
+
+
+CODECS = {c.id: c for c in (JSONCodec, MsgpackCodec, PickleCodec)}
+if msgpack is None:
+    del CODECS[MsgpackCodec.id]
+DEFAULT_CODEC = MsgpackCodec if msgpack else JSONCodec
+# Unpickling runs whatever the peer sends, so servers take pickle only when
+# asked to.
+SERVER_CODECS = tuple(c for c in CODECS.values() if c is not PickleCodec)
+
+
+def get_codec(codec):
+    if codec is None:
+        return DEFAULT_CODEC
+    if isinstance(codec, str):
+        for c in CODECS.values():
+            if c.name == codec:
+                return c
+        raise ValueError("Unsupported codec: {}".format(codec))
+    return codec
 
 
 class Port(object):
-    HEADER_STRUCT = ">L"
+    HEADER_STRUCT = ">BHLL"
     HEADER_LEN = struct.calcsize(HEADER_STRUCT)
-
-    def __init__(self, sock):
+    BUFFER_LEN_STRUCT = ">{}Q"
+    BUFFER_SIZE = 1 << 16
+
+    # Each frame names the codec of its payload. A port starts with JSON,
+    # which every peer understands, and replies in the codec of the last
+    # frame it read, so the client's choice of codec is what gets used.
+    # Frames also carry a request id so that calls can share a connection.
+    # A frame in a codec that is not among codecs closes the port.
+    def __init__(self, sock, codec=JSONCodec, codecs=CODECS):
         self._sock = sock
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.codec = codec
+        self.codecs = codecs
+        self._header = bytearray(self.HEADER_LEN)
+        self._buf = bytearray(self.BUFFER_SIZE)
+        self._write_lock = BoundedSemaphore(1)
 
     def __del__(self):
         self._sock.close()
 
+    def recv_into(self, view):
+        while len(view):
+            length = safe_recv_into(self._sock, view)
+            if not length: return False
+            view = view[length:]
+        return True
+
     def read(self):
-        header = safe_recv(self._sock, self.HEADER_LEN)
-        if not header: return False
-        length = struct.unpack(self.HEADER_STRUCT, header)[0]
-        chunks = []
-        while length:
-            recv = safe_recv(self._sock, length)
-            if not recv: return False
-            chunks.append(recv)
-            length -= len(recv)
-        buf = b"".join(chunks).decode("utf-8")
-        return load(buf)
-
-    def write(self, buf):
-        buf = dump(buf).encode("utf-8")
-        msg = struct.pack(self.HEADER_STRUCT, len(buf)) + buf
-        return safe_send(self._sock, msg)
+        frame = self.read_frame()
+        return frame and frame[1]
+
+    def read_frame(self):
+        if not self.recv_into(memoryview(self._header)): return False
+        codec_id, num_buffers, rid, length = struct.unpack(
+            self.HEADER_STRUCT, self._header)
+        codec = self.codecs.get(codec_id)
+        if not codec:
+            self._sock.close()
+            return False
+        self.codec = codec
+        sizes = ()
+        if num_buffers:
+            buf = bytearray(8 * num_buffers)
+            if not self.recv_into(memoryview(buf)): return False
+            sizes = struct.unpack(self.BUFFER_LEN_STRUCT.format(num_buffers),
+                                  buf)
+        if length > len(self._buf):
+            self._buf = bytearray(length)
+        payload = memoryview(self._buf)[:length]
+        if not self.recv_into(payload): return False
+        buffers = []
+        for size in sizes:
+            buf = bytearray(size)
+            if not self.recv_into(memoryview(buf)): return False
+            buffers.append(buf)
+        return rid, self.codec.loads(payload, buffers)
+
+    def write(self, obj, rid=0):
+        payload, buffers = self.codec.dumps(obj)
+        header = struct.pack(self.HEADER_STRUCT, self.codec.id, len(buffers),
+                             rid, len(payload))
+        if buffers:
+            header += struct.pack(
+                self.BUFFER_LEN_STRUCT.format(len(buffers)),
+                *(b.nbytes for b in buffers))
+        with self._write_lock:
+            return self.send_frame(header, payload, buffers)
+
+    def send_frame(self, header, payload, buffers):
+        if len(payload) < self.BUFFER_SIZE:
+            if not safe_send(self._sock, header + payload): return False
+        elif not (safe_send(self._sock, header)
+                  and safe_send(self._sock, payload)):
+            return False
+        for buf in buffers:
+            if not safe_send(self._sock, buf): return False
+        return True
 
     def close(self):
-        self._sock.shutdown(socket.SHUT_RDWR)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._sock.close()
 
+    def fileno(self):
+        return self._sock.fileno()
+
     @property
     def peer_name(self):
         return self._sock.getpeername()
 
 
+class Channel(object):
+    # Client side of a shared connection: every call gets its own request
+    # id and a reader greenlet routes the replies back to their callers.
+    def __init__(self, port, shared=True):
+        self.port = port
+        self.shared = shared
+        self.ids = count(1)
+        self.pending = {}
+        self.reader = gevent.spawn(self.read_loop)
+
+    def read_loop(self):
+        while True:
+            frame = self.port.read_frame()
+            if not frame:
+                break
+            rid, obj = frame
+            queue = self.pending.get(rid)
+            if queue is not None:
+                queue.put(obj)
+        pending, self.pending = self.pending, {}
+        for queue in pending.values():
+            queue.put(False)
+
+    def stream(self):
+        return Stream(self, next(self.ids))
+
+    def close(self):
+        self.port.close()
+
+
+class Stream(object):
+    def __init__(self, channel, rid):
+        self.channel = channel
+        self.rid = rid
+        self.replies = Queue()
+        self.on_close = None
+        if channel.reader.dead:
+            self.replies.put(False)
+        else:
+            channel.pending[rid] = self.replies
+
+    def write(self, obj):
+        return self.channel.port.write(obj, self.rid)
+
+    def read(self):
+        return self.replies.get()
+
+    def close(self):
+        self.channel.pending.pop(self.rid, None)
+        if not self.channel.shared:
+            self.channel.close()
+        if self.on_close:
+            self.on_close()
+            self.on_close = None
+
+
+class ConnectionPool(object):
+    # Calls are spread over at most size connections to one worker, each
+    # carrying up to streams calls at a time; callers beyond that wait.
+    def __init__(self, addr, codec, size=4, streams=64, times=10,
+                 interval=0.05):
+        self.addr = addr
+        self.codec = codec
+        self.size = size
+        self.times = times
+        self.interval = interval
+        self.channels = []
+        self.slots = Semaphore(size * streams)
+        self.connect_lock = BoundedSemaphore(1)
+        self.connects = 0
+        self.connect_time = 0
+        self.waits = 0
+        self.wait_time = 0
+
+    def connect(self, shared=True):
+        st = timer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if not try_connect(sock, self.addr, self.times, self.interval):
+            sock.close()
+            raise ConnectionError("Cannot connect to {}:{}".format(
+                *self.addr))
+        self.connects += 1
+        self.connect_time += timer() - st
+        return Channel(Port(sock, self.codec), shared)
+
+    def channel(self):
+        self.channels = [c for c in self.channels if not c.reader.dead]
+        idle = [c for c in self.channels if not c.pending]
+        if idle:
+            return idle[0]
+        if len(self.channels) < self.size:
+            with self.connect_lock:
+                if len(self.channels) < self.size:
+                    self.channels.append(self.connect())
+                    return self.channels[-1]
+        return min(self.channels, key=lambda c: len(c.pending))
+
+    def stream(self):
+        if self.slots.locked():
+            st = timer()
+            self.slots.acquire()
+            self.waits += 1
+            self.wait_time += timer() - st
+        else:
+            self.slots.acquire()
+        try:
+            stream = self.channel().stream()
+        except Exception:
+            self.slots.release()
+            raise
+        stream.on_close = self.slots.release
+        return stream
+
+    def close(self):
+        channels, self.channels = self.channels, []
+        for channel in channels:
+            channel.close()
+
+    def stats(self):
+        return {
+            "connections": len(self.channels),
+            "connects": self.connects,
+            "connect_time": self.connect_time,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+        }
+
+
+class Forker(object):
+    LENGTH_STRUCT = ">L"
+    LENGTH_LEN = struct.calcsize(LENGTH_STRUCT)
+
+    # Forked from the server before it spawns any greenlet, so that calls
+    # needing their own process are forked from a clean parent. Neither it
+    # nor the calls keep the listening socket, which would otherwise stay
+    # bound after the server dies. Both leave through os._exit, never by
+    # unwinding into the server's code and its exit hooks.
+    def __init__(self, server):
+        self.server = server
+        self.lock = BoundedSemaphore(1)
+        parent, child = socket.socketpair()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                parent.close()
+                if server.listen_sock:
+                    server.listen_sock.close()
+                self.serve(child)
+            finally:
+                os._exit(0)
+        child.close()
+        self.channel = parent
+
+    def submit(self, sock, rid, message, codec):
+        payload = pickle.dumps((codec.id, rid, message))
+        with self.lock:
+            stdsocket.send_fds(
+                self.channel,
+                [struct.pack(self.LENGTH_STRUCT, len(payload))],
+                [sock.fileno()])
+            self.channel.sendall(payload)
+
+    def recv_exactly(self, length, buf=b""):
+        while len(buf) < length:
+            chunk = self.channel.recv(length - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return buf
+
+    def serve(self, channel):
+        self.channel = channel
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while True:
+            header, fds, _, _ = stdsocket.recv_fds(channel, self.LENGTH_LEN, 1)
+            header = self.recv_exactly(self.LENGTH_LEN, header)
+            if not header or not fds:
+                break
+            length = struct.unpack(self.LENGTH_STRUCT, header)[0]
+            codec_id, rid, message = pickle.loads(self.recv_exactly(length))
+            if not os.fork():
+                try:
+                    channel.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    os.setpgid(0, 0)
+                    gevent.reinit()
+                    self.server.handle_isolated(
+                        socket.socket(fileno=fds[0]), rid, message,
+                        CODECS[codec_id])
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(0)
+            os.close(fds[0])
+
+
 class RPCServer(object):
-    def __init__(self, C, *args):
+    MODES = ("fork", "prefork", "greenlet")
+
+    def __init__(self, C, *args, mode="fork", processes=None, codecs=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown server mode: {}".format(mode))
         self.instance = C(*args)
+        self.mode = mode
+        self.processes = processes or os.cpu_count()
+        self.codecs = {
+            c.id: c for c in map(get_codec, codecs or SERVER_CODECS)}
+        self.listen_sock = None
 
     def run(self, port=0, pipe=None):
         listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         listen_sock.bind(("", port))
         listen_sock.listen(10000)
+        self.listen_sock = listen_sock
         if pipe:
             pipe.put(listen_sock.getsockname()[1])
         else:
             print("Server<{}> started on port {}".format(
                 self.instance.__class__.__name__, listen_sock.getsockname()[
                     1]))
+        if self.mode == "greenlet":
+            self.serve(listen_sock)
+        elif self.mode == "prefork":
+            procs = [
+                multiprocessing.Process(target=self.serve, args=(listen_sock, ))
+                for _ in range(self.processes)
+            ]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+        else:
+            while True:
+                sock, _ = listen_sock.accept()
+                proc = multiprocessing.Process(
+                    target=self.serve_connection, args=(sock, ))
+                proc.start()
+
+    def serve(self, listen_sock):
+        self.forker = Forker(self)
         while True:
             sock, _ = listen_sock.accept()
-            proc = multiprocessing.Process(
-                target=self.handle_let, args=(sock, ))
-            proc.start()
-
-    def handle_let(self, sock):
-        port = Port(sock)
+            gevent.spawn(self.handle_connection, sock)
+
+    def serve_connection(self, sock):
+        self.listen_sock.close()
+        self.forker = Forker(self)
+        self.handle_connection(sock)
+
+    def is_isolated(self, message):
+        func = getattr(self.instance, message[0], None)
+        return getattr(func, "isolated", False)
+
+    # Isolated calls still running when their connection closes lose their
+    # relay, which tells them that the caller is gone.
+    def handle_connection(self, sock):
+        port = Port(sock, codecs=self.codecs)
+        relays = set()
         while True:
-            port.write(os.getpid())
-            message = port.read()
-            if message:
-                setattr(self.instance, "_port", port)
-                port.write(self.handle(message))
+            frame = port.read_frame()
+            if not frame:
+                break
+            rid, message = frame
+            if self.is_isolated(message):
+                gevent.spawn(self.relay, port, rid, message, relays)
             else:
+                gevent.spawn(self.handle_request, port, rid, message)
+        for local in list(relays):
+            local.close()
+
+    # A method returning a generator streams its items, one frame each,
+    # until the generator ends or the client goes away, then replies None.
+    # A call that raises replies None as well, so its caller is not left
+    # waiting on a connection that stays open.
+    def handle_request(self, port, rid, message):
+        port.write(os.getpid(), rid)
+        setattr(self.instance, "_port", port)
+        try:
+            res = self.handle(message)
+            if isinstance(res, types.GeneratorType):
+                for item in res:
+                    if not port.write(item, rid):
+                        res.close()
+                        return
+                res = None
+        except Exception:
+            traceback.print_exc()
+            res = None
+        port.write(res, rid)
+
+    # Isolated calls run in a process of their own, whose replies come back
+    # over a socket pair and are forwarded on the shared connection. Once
+    # the process is gone a final None is sent, which callers that already
+    # got their reply never read, and which ends the call of those that
+    # did not.
+    def relay(self, port, rid, message, relays):
+        local, remote = socket.socketpair()
+        self.forker.submit(remote, rid, message, port.codec)
+        remote.close()
+        local = Port(local, port.codec)
+        relays.add(local)
+        while True:
+            frame = local.read_frame()
+            if not frame:
                 break
+            port.write(frame[1], rid)
+        relays.discard(local)
+        port.write(None, rid)
+
+    # An isolated process also listens for control calls, which reach the
+    # running call through the instance without another fork.
+    def handle_isolated(self, sock, rid, message, codec):
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listen_sock.bind(control_address(os.getpid()))
+        listen_sock.listen(16)
+        gevent.spawn(self.serve_control, listen_sock)
+        port = Port(sock, codec)
+        self.handle_request(port, rid, message)
+        port.close()
+
+    def serve_control(self, listen_sock):
+        while True:
+            sock, _ = listen_sock.accept()
+            gevent.spawn(self.handle_control, sock)
+
+    def handle_control(self, sock):
+        port = Port(sock, codecs=self.codecs)
+        message = port.read()
+        if message:
+            port.write(self.handle(message))
 
     def handle(self, message):
         func, kwargs = message
@@ -151,6 +615,7 @@ class RProc(object):
         self.kwargs = None
         self.let = None
         self.remote_pid = None
+        self.initialized = Event()
 
     def dump_args(self, kwargs):
         for name, arg in kwargs.items():
@@ -165,21 +630,27 @@ class RProc(object):
     def __call__(self, **kwargs):
         self.kwargs = kwargs
         self.let = gevent.getcurrent()
-        self.remote_pid = self.port.read()
         self.dump_args(kwargs)
-        st = self.port.write((self.func.__name__, kwargs))
-        if st:
-            msg = self.port.read()
-            if msg:
-                return self.load_ret(msg)
+        try:
+            try:
+                st = self.port.write((self.func.__name__, kwargs))
+                if st:
+                    self.remote_pid = self.port.read()
+            finally:
+                self.initialized.set()
+            if self.remote_pid:
+                msg = self.port.read()
+                if msg:
+                    return self.load_ret(msg)
+        finally:
+            self.port.close()
 
     def join(self):
         self.wait_for_init()
         self.let.join()
 
     def wait_for_init(self):
-        while self.let is None:
-            gevent.sleep(0.1)
+        self.initialized.wait()
 
     @property
     def value(self):
@@ -187,11 +658,14 @@ class RProc(object):
 
 
 class RPCClient(object):
-    def __init__(self, C, worker_addr, keep_alive=False):
+    def __init__(self, C, worker_addr, keep_alive=False, codec=None,
+                 pool_size=4):
         self.cls = C
+        self.codec = get_codec(codec)
         self.keep_alive = keep_alive
         self.worker_addr = worker_addr
         self.running_set = []
+        self.pool = ConnectionPool(worker_addr, self.codec, pool_size)
         self.connect()
 
     @property
@@ -199,39 +673,48 @@ class RPCClient(object):
         return self.worker_addr[0]
 
     def connect(self):
-        try_times = 10
         if self.keep_alive:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            if try_connect(sock, self.worker_addr, 10, 1):
-                self.port = Port(sock)
-            else:
-                self.port = None
-        else:
-            self.port = None
+            self.pool.stream().close()
 
     def shutdown(self):
-        if self.port:
-            self.port.close()
-            self.port = None
+        self.pool.close()
 
     def get_port(self, new_port=False):
-        if not self.port or new_port:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try_connect(sock, self.worker_addr, 5, 1)
-            port = Port(sock)
-        else:
-            port = self.port
-        return port
+        if new_port:
+            return self.pool.connect(shared=False).stream()
+        return self.pool.stream()
+
+    def pool_stats(self):
+        return self.pool.stats()
 
     def __getattr__(self, func):
         return RProc(getattr(self.cls, func), self.get_port())
 
     def async_call(self, func, **kwargs):
-        rproc = RProc(getattr(self.cls, func), self.get_port(True))
+        rproc = RProc(getattr(self.cls, func), self.get_port())
         gevent.spawn(rproc, **kwargs)
         return rproc
 
+    # Streams get a connection of their own so that they cannot hold up
+    # calls sharing a pooled one.
+    def iterate(self, func, **kwargs):
+        stream = self.get_port(new_port=True)
+        try:
+            if not stream.write((func, kwargs)) or not stream.read():
+                return
+            while True:
+                item = stream.read()
+                if item is None or item is False:
+                    return
+                yield item
+        finally:
+            stream.close()
+
+    def control(self, rproc, func, **kwargs):
+        rproc.wait_for_init()
+        return RProc(self.cls.control, self.get_port())(
+            pid=rproc.remote_pid, func=func, kwargs=kwargs)
+
     def suspend(self, rproc):
         rproc.wait_for_init()
         return RProc(self.cls.suspend, self.get_port())(pid=rproc.remote_pid)
@@ -243,21 +726,49 @@ class RPCClient(object):
 
 class RPC(object):
     default_port = 10000
+    server_mode = "greenlet"
+    _local = gevent.local.local()
 
+    # codecs names the codecs the server accepts, by default all but pickle.
     @classmethod
-    def server(cls, *args):
-        RPCServer(cls, *args).run(cls.default_port)
+    def server(cls, *args, mode=None, processes=None, codecs=None):
+        RPCServer(
+            cls, *args, mode=mode or cls.server_mode, processes=processes,
+            codecs=codecs).run(cls.default_port)
+
+    @property
+    def _port(self):
+        return self._local.port
+
+    @_port.setter
+    def _port(self, port):
+        self._local.port = port
 
     @classmethod
-    def client(cls, addr, port=None, keep_alive=True):
+    def client(cls, addr, port=None, keep_alive=True, codec=None,
+               pool_size=4):
         port = port or cls.default_port
-        return RPCClient(cls, (addr, port), keep_alive)
+        return RPCClient(cls, (addr, port), keep_alive, codec, pool_size)
 
     def hello(self):
         return "Hello!"
 
+    def control(self, pid, func, kwargs):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(control_address(pid))
+        except OSError:
+            sock.close()
+            return False
+        port = Port(sock)
+        if port.write((func, kwargs)):
+            return port.read()
+        return False
+
+    # Isolated calls lead their own process group, which takes any helper
+    # processes they fork along with them.
     def suspend(self, pid):
-        os.kill(pid, signal.SIGSTOP)
+        os.killpg(pid, signal.SIGSTOP)
 
     def resume(self, pid):
-        os.kill(pid, signal.SIGCONT)
+        os.killpg(pid, signal.SIGCONT)
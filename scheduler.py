@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 
-import json
+from collections import defaultdict
 from copy import copy
+import bisect
 import heapq
 import gevent.pool
+from gevent.event import Event
 from gevent.lock import BoundedSemaphore
 from timeit import default_timer as timer
 from math import ceil
-import os.path
+from itertools import count
 from random import gauss
 from tqdm import tqdm
+from loader import load_schedule, schedule_name, DEFAULT_CACHE_DIR
+from network import Link, Network, INFINITY
 
 
 class Task(object):
+    __slots__ = ("tid", "runtime", "resources", "planned_st", "machine",
+                 "succs", "outputs", "remaining_prevs")
+
     def __init__(self, tid, runtime, resources, planned_st, machine):
         self.tid = tid
         self.runtime = runtime
@@ -24,14 +31,21 @@ class Task(object):
         self.outputs = []
         self.remaining_prevs = 0
 
+    def duration(self):
+        return self.runtime
+
     def execute(self):
-        gevent.sleep(self.runtime)
+        gevent.sleep(self.duration())
 
     def __repr__(self):
         return "Task<{}>[{}s]".format(self.tid, self.runtime)
 
 
 class Comm(object):
+    __slots__ = ("from_task", "to_task", "data_size", "planned_st",
+                 "planned_ft")
+    rate = 125829120
+
     def __init__(self, from_task, to_task, data_size, planned_st, planned_ft):
         self.from_task = from_task
         self.to_task = to_task
@@ -39,9 +53,11 @@ class Comm(object):
         self.planned_st = planned_st
         self.planned_ft = planned_ft
 
+    def duration(self):
+        return ceil(self.data_size / self.rate)
+
     def execute(self):
-        rate = 125829120
-        gevent.sleep(ceil(self.data_size / rate))
+        gevent.sleep(self.duration())
 
     def suspend(self):
         pass
@@ -53,50 +69,87 @@ class Comm(object):
         return "COMM<{}=>{}>".format(self.from_task.tid, self.to_task.tid)
 
 
+class Arbiter(object):
+    # Comms sharing one direction of a NIC, in a heap by planned_ft: only
+    # the top one runs and every other one stays suspended. Finished comms
+    # below the top are dropped lazily when they surface.
+    def __init__(self):
+        self.heap = []
+        self.removed = set()
+        self.waiting = []
+        self.counter = count()
+        self.lock = BoundedSemaphore(1)
+        self.preemptions = 0
+
+    @property
+    def current(self):
+        return self.heap[0][2] if self.heap else None
+
+    def admits(self, comm):
+        current = self.current
+        return current is None or comm.planned_ft < current.planned_ft
+
+    # Returns the comm suspended to make room, if any.
+    def add(self, comm):
+        with self.lock:
+            current = self.current
+            heapq.heappush(self.heap,
+                           (comm.planned_ft, next(self.counter), comm))
+            suspended = comm if self.current is current else current
+            if suspended:
+                self.preemptions += 1
+                suspended.suspend()
+            return suspended
+
+    # Due comms that this arbiter blocks wait here, in the order they are
+    # to be retried in once it changes.
+    def wait(self, entry):
+        heapq.heappush(self.waiting, entry)
+
+    # Returns the comm resumed in its place, if any.
+    def remove(self, comm):
+        with self.lock:
+            if self.current is not comm:
+                self.removed.add(comm)
+                return None
+            heapq.heappop(self.heap)
+            while self.heap and self.heap[0][2] in self.removed:
+                self.removed.discard(heapq.heappop(self.heap)[2])
+            resumed = self.current
+            if resumed:
+                resumed.resume()
+            return resumed
+
+
 class Machine(object):
-    def __init__(self, capacities):
+    def __init__(self, capacities, mid=0):
+        self.mid = mid
         self.remaining_resources = copy(capacities)
         self.remaining_resources[0] = (self.remaining_resources[0] * 1000)
-        self.suspended_sending = []
-        self.suspended_receiving = []
-        self.current_receiving = None
-        self.current_sending = None
-        self.sending_lock = BoundedSemaphore(1)
-        self.receiving_lock = BoundedSemaphore(1)
+        self.capacities = copy(self.remaining_resources)
+        self.sending = Arbiter()
+        self.receiving = Arbiter()
+        self.ready_tasks = TaskQueue()
+
+    @property
+    def current_sending(self):
+        return self.sending.current
+
+    @property
+    def current_receiving(self):
+        return self.receiving.current
 
     def add_sending_comm(self, comm):
-        self.sending_lock.acquire()
-        if self.current_sending:
-            self.current_sending.suspend()
-            self.suspended_sending.append(self.current_sending)
-        self.current_sending = comm
-        self.sending_lock.release()
-
-    def finish_sending_comm(self):
-        self.sending_lock.acquire()
-        if self.suspended_sending:
-            self.current_sending = self.suspended_sending.pop()
-            self.current_sending.resume()
-        else:
-            self.current_sending = None
-        self.sending_lock.release()
+        return self.sending.add(comm)
+
+    def finish_sending_comm(self, comm):
+        return self.sending.remove(comm)
 
     def add_receiving_comm(self, comm):
-        self.receiving_lock.acquire()
-        if self.current_receiving:
-            self.suspended_receiving.append(self.current_receiving)
-            self.current_receiving.suspend()
-        self.current_receiving = comm
-        self.receiving_lock.release()
-
-    def finish_receiving_comm(self):
-        self.receiving_lock.acquire()
-        if self.suspended_receiving:
-            self.current_receiving = self.suspended_receiving.pop()
-            self.current_receiving.resume()
-        else:
-            self.current_receiving = None
-        self.receiving_lock.release()
+        return self.receiving.add(comm)
+
+    def finish_receiving_comm(self, comm):
+        return self.receiving.remove(comm)
 
     def remove_resources(self, resources):
         self.remaining_resources[0] -= resources[0]
@@ -107,55 +160,161 @@ class Machine(object):
         self.remaining_resources[1] += resources[1]
 
 
+class ReadyQueue(object):
+    def __init__(self):
+        self.pending = []
+        self.due = []
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.pending) + len(self.due)
+
+    def add(self, item):
+        heapq.heappush(self.pending,
+                       (item.planned_st, next(self.counter), item))
+
+    def defer(self, item):
+        heapq.heappush(self.due, (item.planned_st, next(self.counter), item))
+
+    def release(self, current_time):
+        items = []
+        while self.pending and self.pending[0][0] <= current_time:
+            items.append(heapq.heappop(self.pending)[2])
+        return items
+
+    def next_time(self):
+        return self.pending[0][0] if self.pending else None
+
+
+class TaskQueue(ReadyQueue):
+    # A machine's due tasks, kept sorted in planned order. Tasks that do not
+    # fit stay where they are, and admission stops as soon as the machine
+    # has less left than the smallest demand queued, which is tracked as a
+    # lower bound and made exact by every full scan.
+    def __init__(self):
+        super().__init__()
+        self.min_demand = (INFINITY, INFINITY)
+
+    def defer(self, task):
+        bisect.insort(self.due, (task.planned_st, next(self.counter), task))
+        cpu, memory = task.resources
+        self.min_demand = (min(self.min_demand[0], cpu),
+                           min(self.min_demand[1], memory))
+
+    # Takes the due tasks that fit in remaining, in planned order.
+    def admit(self, remaining):
+        cpu, memory = remaining
+        least_cpu, least_memory = self.min_demand
+        if cpu < least_cpu or memory < least_memory:
+            return []
+        taken = []
+        min_cpu = min_memory = INFINITY
+        for i, (_, _, task) in enumerate(self.due):
+            task_cpu, task_memory = task.resources
+            if task_cpu <= cpu and task_memory <= memory:
+                taken.append(i)
+                cpu -= task_cpu
+                memory -= task_memory
+                if cpu < least_cpu or memory < least_memory:
+                    break
+            else:
+                if task_cpu < min_cpu:
+                    min_cpu = task_cpu
+                if task_memory < min_memory:
+                    min_memory = task_memory
+        else:
+            self.min_demand = (min_cpu, min_memory)
+        if not taken:
+            return []
+        admitted = [self.due[i][2] for i in taken]
+        kept = []
+        start = 0
+        for i in taken:
+            kept.extend(self.due[start:i])
+            start = i + 1
+        kept.extend(self.due[start:])
+        self.due = kept
+        return admitted
+
+
 class Scheduler(object):
     task_cls = Task
     comm_cls = Comm
 
-    def __init__(self, allow_share=False, allow_preemptive=False):
+    def __init__(self, allow_share=False, allow_preemptive=False,
+                 compact=False, cache_dir=DEFAULT_CACHE_DIR, bandwidth=None):
         self.allow_share = allow_share
         self.allow_preemptive = not allow_share and allow_preemptive
+        self.compact = compact
+        self.cache_dir = cache_dir
+        self.bandwidth = bandwidth
+        self.network = None
+        self.tracer = None
         self.log = False
+        self.simulated = False
 
     def load(self, path):
-        self.alg_name = os.path.basename(path)[:-9]
-        with open(path) as f:
-            raw_schedule = json.load(f)
-        self.num_tasks = raw_schedule["num_tasks"]
-        num_machines = len(raw_schedule["machines"])
-        capacities = raw_schedule["vm_capacities"]
-        self.allow_share = self.allow_share or raw_schedule["allow_share"]
-        self.allow_preemptive = self.allow_preemptive or raw_schedule["allow_preemptive"]
-
+        self.alg_name = schedule_name(path)
+        meta, self.graph = load_schedule(path, self.cache_dir)
+        self.num_tasks = meta["num_tasks"]
+        capacities = meta["vm_capacities"]
+        self.allow_share = self.allow_share or meta["allow_share"]
+        self.allow_preemptive = self.allow_preemptive or meta["allow_preemptive"]
+
+        self.machines = [
+            Machine(capacities, mid) for mid in range(meta["num_machines"])
+        ]
         self.tasks = {}
-        self.machines = []
-        for raw_machine in raw_schedule["machines"]:
-            machine = Machine(capacities)
-            self.machines.append(machine)
-            for raw_task in raw_machine:
-                tid = raw_task["id"]
-                self.tasks[tid] = self.task_cls(
-                    tid, raw_task["runtime"], raw_task["resources"],
-                    raw_task["start_time"], machine)
-
-        for raw_machine in raw_schedule["machines"]:
-            for raw_task in raw_machine:
-                task = self.tasks[raw_task["id"]]
-                for sid in raw_task["succs"]:
-                    task.succs.append(self.tasks[sid])
-                    self.tasks[sid].remaining_prevs += 1
-                for comm in raw_task["output"]:
-                    to_task = self.tasks[comm["to_task"]]
-                    to_task.remaining_prevs += 1
-                    data = self.comm_cls(task, to_task, comm["data_size"],
-                                         comm["start_time"],
-                                         comm["finish_time"])
-                    task.outputs.append(data)
-
-    def exec_task(self, task):
-        if self.log: print("[S][{:.2f}s]{}".format(timer() - self.RST, task))
-        task.execute()
+        if self.compact:
+            for task in self.graph.bind(self.task_cls, self.comm_cls,
+                                        self.machines):
+                self.tasks[task.tid] = task
+            return
+
+        graph = self.graph
+        tasks = [
+            self.task_cls(tid, runtime, resources, planned_st,
+                          self.machines[mid])
+            for tid, runtime, resources, planned_st, mid in zip(
+                graph.tids.tolist(), graph.runtime.tolist(),
+                graph.resources.tolist(), graph.planned_st.tolist(),
+                graph.machine.tolist())
+        ]
+        succ_ptr = graph.succ_ptr.tolist()
+        succ_idx = graph.succ_idx.tolist()
+        for task, remaining_prevs, start, end in zip(
+                tasks, graph.initial_prevs().tolist(), succ_ptr, succ_ptr[1:]):
+            task.remaining_prevs = remaining_prevs
+            task.succs = [tasks[i] for i in succ_idx[start:end]]
+        for src, dst, data_size, planned_st, planned_ft in zip(
+                graph.comm_src.tolist(), graph.comm_dst.tolist(),
+                graph.data_size.tolist(), graph.comm_planned_st.tolist(),
+                graph.comm_planned_ft.tolist()):
+            tasks[src].outputs.append(
+                self.comm_cls(tasks[src], tasks[dst], data_size, planned_st,
+                              planned_ft))
+        for task in tasks:
+            self.tasks[task.tid] = task
+
+    def now(self):
+        if self.simulated:
+            return self.clock
+        return timer() - self.RST
+
+    # The time up to which planned starts are due, which subclasses may set
+    # ahead of now() to dispatch early.
+    def dispatch_time(self):
+        return self.now()
+
+    def task_started(self, task):
+        if self.tracer: self.tracer.start(task, self.now())
+        if self.log: print("[S][{:.2f}s]{}".format(self.now(), task))
+
+    def task_finished(self, task):
+        if self.tracer: self.tracer.task(task, self.now())
         self.remaining_tasks -= 1
         task.machine.add_resources(task.resources)
+        self.dirty_machines.add(task.machine)
 
         for t in task.succs:
             t.remaining_prevs -= 1
@@ -163,97 +322,288 @@ class Scheduler(object):
                 self.ready_tasks.add(t)
         for c in task.outputs:
             self.ready_comms.add(c)
+        self.wakeup.set()
         if self.log:
             print("[F][{:.2f}s]{}[{}/{}]".format(
-                timer() - self.RST, task, self.num_tasks -
-                self.remaining_tasks, self.num_tasks))
+                self.now(), task, self.num_tasks - self.remaining_tasks,
+                self.num_tasks))
 
-    def exec_comm(self, comm):
-        if self.log: print("[S][{:.2f}s]{}".format(timer() - self.RST, comm))
+    def comm_started(self, comm):
+        if self.tracer: self.tracer.start(comm, self.now())
+        if self.log: print("[S][{:.2f}s]{}".format(self.now(), comm))
+
+    def comm_finished(self, comm):
+        if self.tracer: self.tracer.comm(comm, self.now())
         from_task = comm.from_task
         to_task = comm.to_task
 
-        comm.execute()
         if not self.allow_share:
-            from_task.machine.finish_sending_comm()
-            to_task.machine.finish_receiving_comm()
+            self.comm_resumed(from_task.machine.finish_sending_comm(comm))
+            self.comm_resumed(to_task.machine.finish_receiving_comm(comm))
+            self.dirty_arbiters.add(from_task.machine.sending)
+            self.dirty_arbiters.add(to_task.machine.receiving)
+            if comm in self.suspensions:
+                since = self.suspensions.pop(comm)[1]
+                self.suspended_time[comm] += self.now() - since
 
         to_task.remaining_prevs -= 1
         if not to_task.remaining_prevs:
             self.ready_tasks.add(comm.to_task)
-        if self.log: print("[F][{:.2f}s]{}".format(timer() - self.RST, comm))
+        self.wakeup.set()
+        if self.log: print("[F][{:.2f}s]{}".format(self.now(), comm))
 
-    def comm_is_ready(self, comm):
-        if self.allow_share:
-            return True
-        elif self.allow_preemptive:
-            for current_comm in [
-                    comm.from_task.machine.current_sending,
-                    comm.to_task.machine.current_receiving
-            ]:
-                current_comm = comm.from_task.machine.current_sending
-                if current_comm and current_comm.planned_ft < comm.planned_ft:
-                    return False
-            return True
+    def exec_task(self, task):
+        self.task_started(task)
+        task.execute()
+        self.task_finished(task)
+
+    def exec_comm(self, comm):
+        self.comm_started(comm)
+        comm.execute()
+        self.comm_finished(comm)
+
+    def start_task(self, task):
+        if self.simulated:
+            self.task_started(task)
+            self.push_event(task.duration(), self.task_finished, task)
         else:
-            return not (comm.from_task.machine.current_sending
-                        or comm.to_task.machine.current_receiving)
+            self.group.spawn(self.exec_task, task)
+
+    def start_comm(self, comm):
+        if self.simulated:
+            self.comm_started(comm)
+            if self.network:
+                self.network.add_flow(comm, (comm.from_task.machine.uplink,
+                                             comm.to_task.machine.downlink),
+                                      comm.data_size)
+            else:
+                self.push_event(comm.duration(), self.comm_finished, comm)
+        else:
+            self.group.spawn(self.exec_comm, comm)
+
+    # Either end of a comm may suspend it, so it counts as suspended from
+    # the first suspension until the last resume.
+    def comm_suspended(self, comm):
+        if not comm:
+            return
+        count, since = self.suspensions.get(comm, (0, self.now()))
+        self.suspensions[comm] = (count + 1, since)
+        if self.simulated and self.network:
+            self.network.pause(comm)
+
+    def comm_resumed(self, comm):
+        if not comm:
+            return
+        count, since = self.suspensions.pop(comm)
+        if count > 1:
+            self.suspensions[comm] = (count - 1, since)
+        else:
+            self.suspended_time[comm] += self.now() - since
+        if self.simulated and self.network:
+            self.network.resume(comm)
+
+    def comm_stats(self):
+        return {
+            "preemptions": sum(m.sending.preemptions + m.receiving.preemptions
+                               for m in self.machines),
+            "suspended_comms": len(self.suspended_time),
+            "suspended_time": sum(self.suspended_time.values()),
+        }
+
+    def push_event(self, delay, handler, obj):
+        heapq.heappush(self.events, (self.clock + delay,
+                                     next(self.event_counter), handler, obj))
+
+    # The arbiter that keeps a comm from starting, if any. Comms can only
+    # become ready when their blocker changes, so that is when they are
+    # retried.
+    def comm_blocker(self, comm):
+        if self.allow_share:
+            return None
+        for arbiter in (comm.from_task.machine.sending,
+                        comm.to_task.machine.receiving):
+            if self.blocks(arbiter, comm):
+                return arbiter
+        return None
+
+    def blocks(self, arbiter, comm):
+        if self.allow_preemptive:
+            return not arbiter.admits(comm)
+        return arbiter.current is not None
 
-    def task_is_ready(self, task):
-        return all(
-            x >= y
-            for x, y in zip(task.machine.remaining_resources, task.resources))
+    def comm_is_ready(self, comm):
+        return self.comm_blocker(comm) is None
 
     def schedule(self):
-        current_time = timer() - self.RST
-        for t in sorted(self.ready_tasks, key=lambda t: t.planned_st):
-            if t.planned_st > current_time:
-                break
-            if self.task_is_ready(t) and t in self.ready_tasks:
-                self.ready_tasks.remove(t)
-                t.machine.remove_resources(t.resources)
-                self.group.spawn(self.exec_task, t)
-        for c in sorted(self.ready_comms, key=lambda c: c.planned_st):
-            if c.planned_st > current_time:
-                break
-            if self.comm_is_ready(c) and c in self.ready_comms:
-                self.ready_comms.remove(c)
-                if not self.allow_share:
-                    c.from_task.machine.add_sending_comm(c)
-                    c.to_task.machine.add_receiving_comm(c)
-                self.group.spawn(self.exec_comm, c)
+        current_time = self.dispatch_time()
+        for t in self.ready_tasks.release(current_time):
+            t.machine.ready_tasks.defer(t)
+            self.dirty_machines.add(t.machine)
+        dirty_machines, self.dirty_machines = self.dirty_machines, set()
+        for machine in dirty_machines:
+            for t in machine.ready_tasks.admit(machine.remaining_resources):
+                machine.remove_resources(t.resources)
+                self.start_task(t)
+        dirty_arbiters, self.dirty_arbiters = self.dirty_arbiters, set()
+        candidates = [(self.comm_key(c), next(self.comm_counter), c, None)
+                      for c in self.ready_comms.release(current_time)]
+        for arbiter in dirty_arbiters:
+            if arbiter.waiting:
+                candidates.append(arbiter.waiting[0] + (arbiter, ))
+        heapq.heapify(candidates)
+        while candidates:
+            key, seq, c, arbiter = heapq.heappop(candidates)
+            if arbiter:
+                if self.blocks(arbiter, c):
+                    continue
+                heapq.heappop(arbiter.waiting)
+                if arbiter.waiting:
+                    heapq.heappush(candidates,
+                                   arbiter.waiting[0] + (arbiter, ))
+            blocker = self.comm_blocker(c)
+            if blocker:
+                blocker.wait((key, seq, c))
+            else:
+                self.begin_comm(c)
+
+    # Due comms are tried in planned order, or in order of urgency when
+    # comms preempt each other. Either way, once an arbiter blocks one of
+    # its waiting comms it blocks every later one too, so each arbiter is
+    # only retried up to its first comm that is still blocked.
+    def comm_key(self, comm):
+        return comm.planned_ft if self.allow_preemptive else comm.planned_st
+
+    def begin_comm(self, comm):
+        if not self.allow_share:
+            self.comm_suspended(comm.from_task.machine.add_sending_comm(comm))
+            self.comm_suspended(comm.to_task.machine.add_receiving_comm(comm))
+        self.start_comm(comm)
 
     def prepare_workers(self, **kwargs):
         pass
 
-    def run(self, log="d", **kwargs):
+    def init_run(self, log, trace=None):
+        self.tracer = trace
         self.remaining_tasks = self.num_tasks
-        self.prepare_workers(verbose=(log == "d"), **kwargs)
-        self.RST = timer()
-        self.ready_tasks = set(
-            [t for t in self.tasks.values() if not t.remaining_prevs])
-        self.ready_comms = set()
-        self.group = gevent.pool.Group()
-        if log == "d": self.log = True
-        elif log == "p":
-            pbar = tqdm(
+        self.ready_tasks = ReadyQueue()
+        self.ready_comms = ReadyQueue()
+        self.dirty_machines = set()
+        self.dirty_arbiters = set()
+        self.comm_counter = count()
+        self.suspensions = {}
+        self.suspended_time = defaultdict(float)
+        for machine in self.machines:
+            for arbiter in (machine.sending, machine.receiving):
+                arbiter.preemptions = 0
+                arbiter.waiting = []
+        # Runs count dependencies down, so every run starts from the counts
+        # of the loaded graph.
+        if self.compact:
+            self.graph.remaining_prevs = self.graph.initial_prevs()
+        else:
+            for t, remaining_prevs in zip(self.tasks.values(),
+                                          self.graph.initial_prevs().tolist()):
+                t.remaining_prevs = remaining_prevs
+        for t in self.tasks.values():
+            if not t.remaining_prevs:
+                self.ready_tasks.add(t)
+        self.wakeup = Event()
+        self.log = log == "d"
+        if log == "p":
+            self.pbar = tqdm(
                 total=self.num_tasks-1,
                 unit="task",
                 desc="{:<32}".format(self.alg_name))
+
+    def update_progress(self, log):
+        if log == "p":
+            self.pbar.update(self.num_tasks - self.remaining_tasks -
+                             self.pbar.n)
+
+    def finish_run(self, log, makespan):
+        if log == "p": self.pbar.close()
+        elif log != "q":
+            print("Makespan of {}: {:.2f}s".format(self.alg_name, makespan))
+        return makespan
+
+    def run(self, log="d", trace=None, **kwargs):
+        self.prepare_workers(verbose=(log == "d"), **kwargs)
+        self.RST = timer()
+        self.group = gevent.pool.Group()
+        self.init_run(log, trace)
         while self.remaining_tasks:
+            self.wakeup.clear()
             self.schedule()
-            if log == "p":
-                pbar.update(self.num_tasks - self.remaining_tasks - pbar.n)
-            gevent.sleep(0.1)
-        if log == "p": pbar.close()
-        else:
-            print("Makespan of {}: {:.2f}s".format(self.alg_name,
-                                                   timer() - self.RST))
+            self.update_progress(log)
+            next_time = self.next_dispatch_time()
+            if next_time is None:
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(max(next_time - self.dispatch_time(), 0))
+        return self.finish_run(log, timer() - self.RST)
+
+    def next_dispatch_time(self):
+        times = [
+            t for t in (self.ready_tasks.next_time(),
+                        self.ready_comms.next_time()) if t is not None
+        ]
+        return min(times) if times else None
+
+    def next_event_time(self):
+        next_time = self.next_dispatch_time()
+        if self.events and (next_time is None
+                            or self.events[0][0] < next_time):
+            next_time = self.events[0][0]
+        if self.network:
+            network_time = self.network.next_time()
+            if network_time < INFINITY and (next_time is None
+                                            or network_time < next_time):
+                next_time = network_time
+        return next_time
+
+    def link_capacities(self):
+        bandwidth = self.bandwidth
+        if isinstance(bandwidth, (int, float)):
+            return [(bandwidth, bandwidth)] * len(self.machines)
+        elif isinstance(bandwidth[0], (int, float)):
+            return [tuple(bandwidth)] * len(self.machines)
+        return bandwidth
+
+    def build_network(self):
+        self.network = Network()
+        for machine, (upload, download) in zip(self.machines,
+                                               self.link_capacities()):
+            machine.uplink = Link(upload)
+            machine.downlink = Link(download)
+
+    def simulate(self, log=None, trace=None):
+        self.simulated = True
+        self.clock = 0
+        self.events = []
+        self.event_counter = count()
+        if self.bandwidth is not None:
+            self.build_network()
+        self.init_run(log, trace)
+        try:
+            while self.remaining_tasks:
+                self.schedule()
+                next_time = self.next_event_time()
+                if next_time is None:
+                    raise RuntimeError("{} stalled at {:.2f}s".format(
+                        self.alg_name, self.clock))
+                self.clock = next_time
+                if self.network:
+                    for comm in self.network.advance(self.clock):
+                        self.comm_finished(comm)
+                while self.events and self.events[0][0] <= self.clock:
+                    _, _, handler, obj = heapq.heappop(self.events)
+                    handler(obj)
+                self.update_progress(log)
+        finally:
+            self.simulated = False
+        return self.finish_run(log, self.clock)
 
 
 if __name__ == "__main__":
-    from sys import argv
-    s = Scheduler(allow_share=True, log=True)
-    for path in argv[1:]:
-        s.load(path)
-        s.run()
+    from batch import main
+    main(allow_share=True)
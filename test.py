@@ -52,6 +52,23 @@ def test_concurrent_communications(num):
         print(p.value.statistic)
 
 
+def test_telemetry_codecs(addr="localhost"):
+    import base64
+    import numpy as np
+    from rpcserver import SERVER_CODECS
+    from tracer import SAMPLE
+    for codec in SERVER_CODECS:
+        monitor = Monitor.client(addr, codec=codec.name)
+        batches = monitor.iterate("telemetry", interval=0.01, flush=0.05)
+        buf = next(batches)
+        batches.close()
+        if isinstance(buf, str):
+            buf = base64.b64decode(buf)
+        samples = np.frombuffer(buf, SAMPLE)
+        assert len(samples) == 5, (codec.name, len(samples))
+        print(codec.name, samples[-1])
+
+
 if __name__ == "__main__":
     # test_monitor_and_worker()
     # test_cluster()
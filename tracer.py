@@ -0,0 +1,225 @@
+import base64
+import gevent
+import json
+import numpy as np
+from collections import defaultdict
+
+TASK = 0
+COMM = 1
+
+RECORD = np.dtype([
+    ("kind", np.uint8),
+    ("id", np.int64),
+    ("target", np.int64),
+    ("planned_st", np.float64),
+    ("start", np.float64),
+    ("finish", np.float64),
+    ("machine", np.int32),
+    ("peer", np.int32),
+])
+
+SAMPLE = np.dtype([
+    ("time", "<f8"),
+    ("cpu", "<f4"),
+    ("memory", "<u8"),
+    ("rx", "<u8"),
+    ("tx", "<u8"),
+])
+
+
+class Tracer(object):
+    def __init__(self, capacity=1 << 20):
+        self.buf = np.zeros(capacity, RECORD)
+        self.count = 0
+        self.starts = {}
+
+    @property
+    def capacity(self):
+        return len(self.buf)
+
+    @property
+    def dropped(self):
+        return max(self.count - self.capacity, 0)
+
+    def start(self, obj, time):
+        self.starts[obj] = time
+
+    def append(self, record):
+        self.buf[self.count % self.capacity] = record
+        self.count += 1
+
+    def task(self, task, time):
+        self.append((TASK, task.tid, -1, task.planned_st,
+                     self.starts.pop(task, time), time, task.machine.mid,
+                     -1))
+
+    def comm(self, comm, time):
+        self.append((COMM, comm.from_task.tid, comm.to_task.tid,
+                     comm.planned_st, self.starts.pop(comm, time), time,
+                     comm.from_task.machine.mid, comm.to_task.machine.mid))
+
+    def records(self):
+        if self.count <= self.capacity:
+            return self.buf[:self.count]
+        split = self.count % self.capacity
+        return np.concatenate([self.buf[split:], self.buf[:split]])
+
+    def chrome_events(self):
+        events = []
+        for r in self.records().tolist():
+            kind, id, target, planned_st, start, finish, machine, peer = r
+            if kind == TASK:
+                name, lane = "Task<{}>".format(id), "tasks"
+            else:
+                name, lane = "COMM<{}=>{}>".format(id, target), "sending"
+            events.append({
+                "name": name,
+                "cat": lane,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (finish - start) * 1e6,
+                "pid": machine,
+                "tid": lane,
+                "args": {
+                    "planned_st": planned_st,
+                    "delay": start - planned_st,
+                    "peer": peer,
+                },
+            })
+        return events
+
+    def export_chrome(self, path, telemetry=None):
+        events = self.chrome_events()
+        if telemetry:
+            events += telemetry.chrome_events()
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+    def columns(self):
+        records = self.records()
+        return {name: records[name] for name in RECORD.names}
+
+    def export_columns(self, path):
+        np.savez(path, **self.columns())
+
+    def export_parquet(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(
+            pyarrow.table(self.columns()), path)
+
+
+def interval_means(time, counter, start, finish):
+    duration = finish - start
+    delta = np.interp(finish, time, counter) - np.interp(start, time, counter)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(duration > 0, delta / duration, np.nan)
+
+
+class Telemetry(object):
+    # Collects the sample streams of the monitors of a run. Sample times are
+    # moved onto the run's clock by origin, the wall time at which it
+    # started, and each worker's clock offset, so that samples line up with
+    # the tracer's records.
+    def __init__(self, interval=0.01, flush=0.25, nic=None):
+        self.interval = interval
+        self.flush = flush
+        self.nic = nic
+        self.origin = 0
+        self.chunks = defaultdict(list)
+        self.lets = []
+
+    def start(self, machines, origin):
+        self.origin = origin
+        for machine in machines:
+            monitor = getattr(machine.worker, "monitor", None)
+            if monitor:
+                offset = getattr(machine.worker, "clock_offset", 0)
+                self.lets.append(
+                    gevent.spawn(self.collect, machine.mid, monitor,
+                                 offset))
+
+    # A monitor shares its host's clock with the worker, so samples are
+    # corrected by the worker's offset.
+    def collect(self, mid, monitor, offset=0):
+        for buf in monitor.iterate("telemetry", interval=self.interval,
+                                   flush=self.flush, nic=self.nic):
+            if isinstance(buf, str):
+                buf = base64.b64decode(buf)
+            samples = np.frombuffer(buf, SAMPLE).copy()
+            samples["time"] -= self.origin + offset
+            self.chunks[mid].append(samples)
+
+    # Waits for the batch in flight so that the end of the run is covered.
+    def stop(self):
+        if self.lets:
+            gevent.sleep(self.flush)
+        gevent.killall(self.lets)
+        self.lets = []
+
+    def samples(self, mid):
+        chunks = self.chunks.get(mid)
+        if not chunks:
+            return np.empty(0, SAMPLE)
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
+    def rates(self, mid):
+        samples = self.samples(mid)
+        time = samples["time"]
+        dt = np.diff(time)
+        return {
+            "time": time[1:],
+            "cpu": samples["cpu"][1:],
+            "memory": samples["memory"][1:],
+            "rx_rate": np.diff(samples["rx"].astype(np.float64)) / dt,
+            "tx_rate": np.diff(samples["tx"].astype(np.float64)) / dt,
+        }
+
+    def chrome_events(self):
+        events = []
+        for mid in sorted(self.chunks):
+            rates = self.rates(mid)
+            for time, cpu, memory, rx, tx in zip(
+                    rates["time"].tolist(), rates["cpu"].tolist(),
+                    rates["memory"].tolist(), rates["rx_rate"].tolist(),
+                    rates["tx_rate"].tolist()):
+                ts = time * 1e6
+                events.append({"name": "cpu", "ph": "C", "ts": ts,
+                               "pid": mid, "args": {"cores": cpu}})
+                events.append({"name": "memory", "ph": "C", "ts": ts,
+                               "pid": mid, "args": {"MB": memory / 2**20}})
+                events.append({"name": "network", "ph": "C", "ts": ts,
+                               "pid": mid, "args": {"rx MB/s": rx / 2**20,
+                                                    "tx MB/s": tx / 2**20}})
+        return events
+
+    # The tracer's columns, plus what the machines actually did over each
+    # record: busy cores and upload rate on its machine, and download rate
+    # on its receiver (the machine itself for tasks).
+    def align(self, tracer):
+        columns = tracer.columns()
+        start, finish = columns["start"], columns["finish"]
+        receiver = np.where(columns["kind"] == COMM, columns["peer"],
+                            columns["machine"])
+        for name in ("cpu", "tx_rate", "rx_rate"):
+            columns[name] = np.full(len(start), np.nan)
+        for mid in self.chunks:
+            samples = self.samples(mid)
+            if len(samples) < 2:
+                continue
+            time = samples["time"]
+            cpu = np.concatenate(
+                [[0], np.cumsum(samples["cpu"][1:] * np.diff(time))])
+            rows = columns["machine"] == mid
+            columns["cpu"][rows] = interval_means(time, cpu, start[rows],
+                                                  finish[rows])
+            columns["tx_rate"][rows] = interval_means(
+                time, samples["tx"].astype(np.float64), start[rows],
+                finish[rows])
+            rows = receiver == mid
+            columns["rx_rate"][rows] = interval_means(
+                time, samples["rx"].astype(np.float64), start[rows],
+                finish[rows])
+        return columns
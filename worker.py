@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
-from time import sleep, perf_counter as timer
+from time import sleep, monotonic, process_time, time, perf_counter as timer
+import argparse
 import subprocess
 import gevent
 from gevent import socket
+from gevent.event import Event
 from math import ceil
-from rpcserver import RPC, Remotable, try_connect
+from rpcserver import RPC, Remotable, isolated, try_connect
+import mmap
+import multiprocessing
 import os
+import resource
 import struct
+import tempfile
+import uuid
 
 
 def bin_format(s, t):
@@ -21,37 +28,296 @@ def bin_format(s, t):
         return s
 
 
+MEMORY_UNIT = 1 << 20
+PAGE_SIZE = mmap.PAGESIZE
+SPIN_PERIOD = 0.01
+
+
+def spin(core, share, cpu_time):
+    if core is not None:
+        os.sched_setaffinity(0, {core})
+    start = process_time()
+    while process_time() - start < cpu_time:
+        period_end = timer() + SPIN_PERIOD
+        busy_until = process_time() + share * SPIN_PERIOD
+        while process_time() < busy_until:
+            pass
+        if share < 1:
+            sleep(max(0, period_end - timer()))
+
+
+class CorePool(object):
+    # Tracks the milli-CPU placed on each core across every process forked
+    # from the worker server, so that tasks spread over the least loaded
+    # cores and only contend once the machine is oversubscribed.
+    def __init__(self, cores=None):
+        self.cores = sorted(cores or os.sched_getaffinity(0))
+        self.load = multiprocessing.Array("i", len(self.cores))
+
+    def acquire(self, shares):
+        allocation = []
+        with self.load.get_lock():
+            for share in shares:
+                i = min(range(len(self.cores)), key=lambda i: self.load[i])
+                self.load[i] += int(share * 1000)
+                allocation.append((i, share))
+        return allocation
+
+    def release(self, allocation):
+        with self.load.get_lock():
+            for i, share in allocation:
+                self.load[i] -= int(share * 1000)
+
+
 class Task(Remotable):
-    state = ["runtime"]
+    state = ["runtime", "cpu", "memory", "cpu_time", "wall_time",
+             "start_time"]
 
-    def __init__(self, runtime):
+    # cpu is in milli-cores and memory in MEMORY_UNIT. A task without
+    # either just sleeps; otherwise it burns the cpu on pinned processes
+    # and holds the memory for its runtime.
+    def __init__(self, runtime, cpu=0, memory=0):
         self.runtime = runtime
+        self.cpu = cpu
+        self.memory = memory
+        self.cpu_time = None
+        self.wall_time = None
+        self.start_time = None
+
+    @property
+    def shares(self):
+        full, part = divmod(int(self.cpu), 1000)
+        return [1] * full + ([part / 1000] if part else [])
 
-    def execute(self):
-        sleep(self.runtime)
+    def execute(self, cores=None):
+        start_time = timer()
+        if self.cpu or self.memory:
+            self.load(cores)
+        else:
+            sleep(self.runtime)
+        self.wall_time = timer() - start_time
+
+    def load(self, cores=None):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        st = usage.ru_utime + usage.ru_stime
+        size = int(self.memory * MEMORY_UNIT)
+        reserved = bytearray(size)
+        reserved[::PAGE_SIZE] = b"\1" * len(range(0, size, PAGE_SIZE))
+        allocation = cores.acquire(self.shares) if cores else [
+            (None, share) for share in self.shares
+        ]
+        pids = []
+        try:
+            for i, share in allocation:
+                pid = os.fork()
+                if not pid:
+                    try:
+                        spin(cores.cores[i] if cores else None, share,
+                             self.runtime * share)
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            if not pids:
+                sleep(self.runtime)
+        finally:
+            for pid in pids:
+                os.waitpid(pid, 0)
+            if cores:
+                cores.release(allocation)
+        del reserved
+        usage = [
+            resource.getrusage(who)
+            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+        ]
+        self.cpu_time = sum(u.ru_utime + u.ru_stime for u in usage) - st
 
 
-# FILE_UNIT_SIZE = 1024 * 1024 * 10
-FILE_UNIT_SIZE = 8192
-HEADER_STRUCT = ">Q"
+FILE_UNIT_SIZE = 1 << 20
+SOCKET_BUFFER_SIZE = 4 << 20
+SEND_METHODS = ("send", "sendfile")
+HEADER_STRUCT = ">16sHHQ"
 HEADER_LEN = struct.calcsize(HEADER_STRUCT)
+ACK_STRUCT = ">Q"
+ACK_LEN = struct.calcsize(ACK_STRUCT)
+
+
+def set_buffer_size(sock, option, size):
+    if size:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+
+def sendfile(sock, f, offset, count, chunk_size, transfer=None):
+    end = offset + count
+    while offset < end:
+        try:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset,
+                               min(chunk_size, end - offset))
+        except BlockingIOError:
+            socket.wait_write(sock.fileno())
+            continue
+        if not sent:
+            break
+        offset += sent
+        if transfer:
+            transfer.advance(sent)
+    return count - (end - offset)
+
+
+def recv_exactly(sock, length):
+    buf = b""
+    while len(buf) < length:
+        chunk = sock.recv(length - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return buf
+
+
+class TokenBucket(object):
+    # Lives in shared memory so that every process forked from the worker
+    # server draws from the same bucket. Consumers take their tokens up
+    # front and sleep off any debt, which keeps the long-run rate exact.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate / 10
+        self.state = multiprocessing.Array("d", [self.burst, monotonic()])
+
+    def consume(self, n):
+        with self.state.get_lock():
+            now = monotonic()
+            tokens, last = self.state[:]
+            tokens = min(self.burst, tokens + (now - last) * self.rate) - n
+            self.state[:] = [tokens, now]
+        if tokens < 0:
+            gevent.sleep(-tokens / self.rate)
+
+
+class Transfer(object):
+    # Senders check in after every chunk, so a pause takes effect at the
+    # next chunk boundary of each stream. pause() returns once every stream
+    # under way has stopped there, with the bytes sent by then.
+    def __init__(self, bucket=None):
+        self.sent = 0
+        self.bucket = bucket
+        self.running = Event()
+        self.running.set()
+        self.streams = 0
+        self.stopped = 0
+        self.settled = Event()
+        self.settled.set()
+
+    def settle(self):
+        if self.stopped == self.streams:
+            self.settled.set()
+        else:
+            self.settled.clear()
+
+    def begin(self):
+        self.running.wait()
+        self.streams += 1
+        self.settle()
+
+    def end(self):
+        self.streams -= 1
+        self.settle()
+
+    def advance(self, sent):
+        self.sent += sent
+        if self.bucket:
+            self.bucket.consume(sent)
+        if not self.running.is_set():
+            self.stopped += 1
+            self.settle()
+            self.running.wait()
+            self.stopped -= 1
+            self.settle()
+
+    def pause(self):
+        self.running.clear()
+        self.settled.wait()
+        return self.sent
+
+    def resume(self):
+        self.running.set()
+        return self.sent
 
 
 class Data(Remotable):
-    state = ["size", "runtime"]
+    state = [
+        "size", "runtime", "chunk_size", "buffer_size", "method", "path",
+        "streams", "transfer_id", "start_time"
+    ]
 
-    def __init__(self, size):
+    # Without a path the payload is zeros, served from an anonymous memory
+    # file when sent with sendfile; with a path it is that file's contents.
+    def __init__(self, size=None, chunk_size=FILE_UNIT_SIZE,
+                 buffer_size=SOCKET_BUFFER_SIZE, method="sendfile",
+                 path=None, streams=1):
+        if method not in SEND_METHODS:
+            raise ValueError("Unknown send method: {}".format(method))
+        if path:
+            file_size = os.path.getsize(path)
+            if size is None:
+                size = file_size
+            elif size > file_size:
+                raise ValueError("{} is smaller than {} bytes".format(
+                    path, size))
         self.size = size
         self.runtime = None
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.method = method
+        self.path = path
+        self.streams = streams
+        self.transfer_id = None
+        self.start_time = None
+
+    def stripes(self):
+        length = ceil(self.size / self.streams) if self.size else 0
+        return [(offset, min(length, self.size - offset))
+                for offset in range(0, self.size, length or 1)] or [(0, 0)]
+
+    def open(self):
+        if self.path:
+            return open(self.path, "rb")
+        if hasattr(os, "memfd_create"):
+            f = os.fdopen(os.memfd_create("data"), "rb")
+        else:
+            f = tempfile.TemporaryFile()
+        os.ftruncate(f.fileno(), self.size)
+        return f
 
-    def send_to(self, sock):
-        fsize = self.size
-        buf = bytearray(FILE_UNIT_SIZE)
-        while fsize:
-            if fsize < FILE_UNIT_SIZE:
-                fsize -= sock.send(buf[:fsize])
+    def send_to(self, sock, offset=0, length=None, transfer=None):
+        if length is None:
+            length = self.size - offset
+        if not length:
+            return
+        if self.method == "sendfile":
+            with self.open() as f:
+                sendfile(sock, f, offset, length, self.chunk_size, transfer)
+        elif self.path:
+            with open(self.path, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as view:
+                    self.send_view(sock, view[offset:offset + length],
+                                   transfer=transfer)
+        else:
+            self.send_view(sock, None, length, transfer)
+
+    def send_view(self, sock, payload, length=None, transfer=None):
+        if length is None:
+            length = len(payload)
+        chunk = memoryview(bytearray(self.chunk_size))
+        sent = 0
+        while sent < length:
+            size = min(self.chunk_size, length - sent)
+            if payload is None:
+                size = sock.send(chunk[:size])
             else:
-                fsize -= sock.send(buf)
+                size = sock.send(payload[sent:sent + size])
+            sent += size
+            if transfer:
+                transfer.advance(size)
 
     @property
     def rate(self):
@@ -59,46 +325,184 @@ class Data(Remotable):
 
     @property
     def statistic(self):
-        return ("{:.0f}MB data transferred in {:.2f}s, {:.0f}MB/s".format(
-            bin_format(self.size, "MB"), self.runtime,
-            bin_format(self.rate, "MB")))
+        return ("{:.0f}MB data transferred in {:.2f}s, {:.0f}MB/s "
+                "({}, {:.0f}KB chunks, {} streams)".format(
+                    bin_format(self.size, "MB"), self.runtime,
+                    bin_format(self.rate, "MB"), self.method,
+                    bin_format(self.chunk_size, "KB"), self.streams))
+
+
+class DataListener(object):
+    # Each stream names its transfer and stripe, and is acknowledged with
+    # the number of bytes received once drained. The payload is discarded,
+    # so every stream reads into the same buffer.
+    def __init__(self, port, chunk_size=FILE_UNIT_SIZE,
+                 buffer_size=SOCKET_BUFFER_SIZE, bucket=None):
+        self.port = port
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.buf = memoryview(bytearray(chunk_size))
+        self.transfers = {}
+
+    def run(self):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_buffer_size(listen_sock, socket.SO_RCVBUF, self.buffer_size)
+        listen_sock.bind(("", self.port))
+        listen_sock.listen(1000)
+        while True:
+            sock, _ = listen_sock.accept()
+            gevent.spawn(self.receive, sock)
+
+    def receive(self, sock):
+        header = recv_exactly(sock, HEADER_LEN)
+        if not header:
+            sock.close()
+            return
+        tid, _, streams, remaining = struct.unpack(HEADER_STRUCT, header)
+        self.transfers[tid] = self.transfers.get(tid, streams)
+        length = remaining
+        while remaining:
+            received = sock.recv_into(self.buf,
+                                      min(remaining, self.chunk_size))
+            if not received:
+                break
+            remaining -= received
+            if self.bucket:
+                self.bucket.consume(received)
+        self.transfers[tid] -= 1
+        if not self.transfers[tid]:
+            del self.transfers[tid]
+        sock.sendall(struct.pack(ACK_STRUCT, length - remaining))
+        sock.close()
 
 
 class Worker(RPC):
-    def execute(self, task: Task) -> Task:
-        task.execute()
+    data_port = 10002
+    upload_rate = None
+    download_rate = None
+    upload = None
+    transfer = None
+    cores = None
+    gate = None
+
+    @classmethod
+    def server(cls, *args, **kwargs):
+        cls.cores = CorePool()
+        if cls.upload_rate:
+            cls.upload = TokenBucket(cls.upload_rate)
+        download = TokenBucket(
+            cls.download_rate) if cls.download_rate else None
+        listener = multiprocessing.Process(
+            target=DataListener(cls.data_port, bucket=download).run,
+            daemon=True)
+        listener.start()
+        super(Worker, cls).server(*args, **kwargs)
+
+    def clock(self):
+        return time()
+
+    # Calls staged ahead of their start wait for release() when gated, then
+    # until start_at on this worker's clock, and report when they started.
+    # A gated call gives up, starting nothing, once its caller's connection
+    # closes.
+    def wait_start(self, start_at, gated):
+        if gated:
+            hangup = gevent.spawn(socket.wait_read, self._port.fileno())
+            gevent.wait([self.start_gate(), hangup], count=1)
+            hangup.kill()
+            if not self.start_gate().is_set():
+                return None
+        if start_at:
+            gevent.sleep(max(start_at - time(), 0))
+        return time()
+
+    def start_gate(self):
+        if not self.gate:
+            self.gate = Event()
+        return self.gate
+
+    def release(self):
+        self.start_gate().set()
+        return True
+
+    @isolated
+    def execute(self, task: Task, start_at=None, gated=False) -> Task:
+        task.start_time = self.wait_start(start_at, gated)
+        if task.start_time is None:
+            return None
+        task.execute(self.cores)
         return task
 
-    def send_to(self, data: Data, target_addr) -> Data:
+    @isolated
+    def send_to(self, data: Data, target_addr, start_at=None,
+                gated=False) -> Data:
+        self.transfer = Transfer(self.upload)
+        data.start_time = self.wait_start(start_at, gated)
+        if data.start_time is None:
+            return None
         start_time = timer()
-        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_sock.bind(("", 0))
-        listen_sock.listen(1)
-        _, port = listen_sock.getsockname()
-        slet = gevent.spawn(self.file_sending_server, listen_sock, data)
-        client = Worker.client(target_addr)
-        client.receive_file(port=port)
-        slet.join()
+        data.transfer_id = uuid.uuid4().hex
+        stripes = data.stripes()
+        lets = [
+            gevent.spawn(self.send_stripe, data, target_addr, i,
+                         len(stripes), offset, length)
+            for i, (offset, length) in enumerate(stripes)
+        ]
+        gevent.joinall(lets, raise_error=True)
         data.runtime = timer() - start_time
         return data
 
-    def file_sending_server(self, listen_sock, data):
-        sock, _ = listen_sock.accept()
-        sock.sendall(struct.pack(HEADER_STRUCT, data.size))
-        data.send_to(sock)
-        sock.close()
-
-    def receive_file(self, port):
+    # target_addr may name the data port as host:port, for several workers
+    # sharing one host.
+    def send_stripe(self, data, target_addr, index, streams, offset, length):
+        host, _, port = target_addr.partition(":")
+        port = int(port) if port else self.data_port
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ip, _ = self._port.peer_name
-        if not try_connect(sock, (ip, port), 20, 0.5): return False
-        header = sock.recv(HEADER_LEN)
-        fsize = struct.unpack(HEADER_STRUCT, header)[0]
-        buf = memoryview(bytearray(FILE_UNIT_SIZE))
-        while fsize:
-            fsize -= sock.recv_into(buf, min(fsize, FILE_UNIT_SIZE))
+        set_buffer_size(sock, socket.SO_SNDBUF, data.buffer_size)
+        if not try_connect(sock, (host, port), 10, 0.05):
+            sock.close()
+            raise ConnectionError("Cannot connect to {}:{}".format(
+                host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(
+            struct.pack(HEADER_STRUCT, bytes.fromhex(data.transfer_id),
+                        index, streams, length))
+        self.transfer.begin()
+        try:
+            data.send_to(sock, offset, length, self.transfer)
+        finally:
+            self.transfer.end()
+        ack = recv_exactly(sock, ACK_LEN)
         sock.close()
+        if not ack or struct.unpack(ACK_STRUCT, ack)[0] != length:
+            raise IOError("Stripe {} of transfer {} was not fully received".
+                          format(index, data.transfer_id))
+
+    def pause_transfer(self):
+        return self.transfer.pause() if self.transfer else False
+
+    def resume_transfer(self):
+        return self.transfer.resume() if self.transfer else False
 
 
 if __name__ == "__main__":
-    Worker.server()
+    parser = argparse.ArgumentParser(description="Run a worker server")
+    parser.add_argument("-p", "--port", type=int, default=Worker.default_port)
+    parser.add_argument("-d", "--data-port", type=int,
+                        default=Worker.data_port)
+    parser.add_argument("-m", "--mode", help="RPC server mode")
+    parser.add_argument("-c", "--codec", action="append", dest="codecs",
+                        help="codec to accept, repeatable (default: all "
+                        "but pickle)")
+    parser.add_argument("--upload-rate", type=float,
+                        help="cap on outgoing data in bytes/s")
+    parser.add_argument("--download-rate", type=float,
+                        help="cap on incoming data in bytes/s")
+    args = parser.parse_args()
+    Worker.default_port = args.port
+    Worker.data_port = args.data_port
+    Worker.upload_rate = args.upload_rate
+    Worker.download_rate = args.download_rate
+    Worker.server(mode=args.mode, codecs=args.codecs)